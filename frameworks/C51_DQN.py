@@ -20,10 +20,10 @@ class C51_DQN(Nature_DQN):
         self.torch_range = torch.arange(args['batch_size']).long().cuda()
 
     def compute_td_loss(self):
-        state, action, reward, next_state, done = self.replay_buffer.sample()
+        state, action, reward, next_state, done, *task = self.replay_buffer.sample() # task: the game of every transition in the multi-task mode
 
         with torch.no_grad():
-            prob_next = self.target_network(next_state)
+            prob_next = self.target_network(next_state, *task)
             q_next = (prob_next * self.atoms_gpu).sum(-1)
             a_next = torch.argmax(q_next, dim=-1)
             prob_next = prob_next[self.torch_range, a_next, :]
@@ -35,7 +35,7 @@ class C51_DQN(Nature_DQN):
         target_prob = (1 - (atoms_target - self.atoms_gpu.view(1, -1, 1)).abs() / self.delta_z).clamp(0, 1) * prob_next.unsqueeze(1)
         target_prob = target_prob.sum(-1)
 
-        log_prob = self.current_network.forward_log(state)
+        log_prob = self.current_network.forward_log(state, *task)
         log_prob = log_prob[self.torch_range, action, :]
         loss = (target_prob * target_prob.add(1e-5).log() - target_prob * log_prob).sum(-1).mean()
 
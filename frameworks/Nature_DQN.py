@@ -10,75 +10,197 @@ from collections import deque
 import time
 from statistics import mean
 from utils.ReplayBufferAsync import ReplayBufferAsync
+from utils.ReplayServiceAsync import ReplayServerAsync, ReplayClient
+from utils.OfflineDataset import DatasetRecorderAsync, OfflineReplayBufferAsync
 from utils.LogAsync import logger
 import torch.multiprocessing as mp
 from utils.ActorAsync import ActorAsync
 import torch.multiprocessing as mp
 from utils.EvaluationAsync import EvaluationAsync
+from utils.ParameterSync import FlatParameters, VersionedSnapshots
+from utils.StartupTimer import startup_timer
+from utils.Exploration import EpsilonSchedule
+from utils.MemoryMonitor import MemoryMonitor, size_replay_buffer
+from utils.Profiler import profiler
+from utils.MultiTaskReplayBufferAsync import MultiTaskReplayBufferAsync
+from utils.Wrapper import game_args
 
 class Nature_DQN:
+    replay_buffer_class = ReplayBufferAsync
+
     def __init__(self, make_env_fun, netowrk_fun, optimizer_fun, *arg, **args):
         self.arg = arg 
         self.args = args 
-        self.env = make_env_fun(**args)
         self.gamma=args['gamma']
         self.gradient_clip = args['gradient_clip']
-        self.eps_start = args['eps_start']
-        self.eps_end = args['eps_end']
-        self.eps_decay_steps = args['eps_decay_steps']
+        self.num_actors = args['num_actors']
+        self.eps_schedules = [EpsilonSchedule(actor_id, **args) for actor_id in range(self.num_actors)] # only for logging, actors compute their own
         self.start_training_steps = args['start_training_steps']
         self.update_target_steps = args['update_target_steps']
+        self.soft_update_tau = args['soft_update_tau']
         self.eval_freq = args['eval_freq']
+        self.deterministic = args['deterministic']
+        self.env_names = args['env_names']
+        if self.env_names is not None and (args['mode'] == 'offline' or args['replay_address'] is not None or args['record_dataset'] is not None):
+            raise Exception('--env_names needs the in process replay buffer, the offline dataset and the replay service are not partitioned by game')
+        if self.env_names is not None and self.num_actors < len(self.env_names):
+            raise Exception('--env_names needs at least one actor per game, increase --num_actors')
+        if args['mode'] == 'offline' and args['offline_dataset'] is None:
+            raise Exception('--mode offline needs the recorded dataset, include --offline_dataset')
+        if self.deterministic and args['replay_address'] is not None:
+            raise Exception('--deterministic needs the in process replay buffer, the replay service is shared and not ordered')
+
+        if self.env_names is not None: # multi-task mode, per game partitions
+            self.replay_buffer_class = MultiTaskReplayBufferAsync
+        replay_buffer_class = OfflineReplayBufferAsync if args['mode'] == 'offline' else self.replay_buffer_class
+        args['buffer_size'], args['replay_spill_dir'], memory_message = size_replay_buffer(replay_buffer_class, **args)
+        if memory_message is not None:
+            logger.terminal_print('(Memory Warning)', {'replay_buffer': memory_message})
+
+        profiler.init('learner', **args)
 
+        # start the workers first, they build their own envs and import what they need in parallel
         self.network_lock = mp.Lock()
-        self.actor = ActorAsync(env = self.env, network_lock = self.network_lock, *arg, **args)
-        self.replay_buffer = ReplayBufferAsync(*arg, **args)
+        self.global_steps = mp.Value('l', 0)
+        # deterministic mode: the actors act with the weights version of their logical step, not the latest weights
+        self.snapshots = VersionedSnapshots(self.num_actors + 1) if self.deterministic else None
+        self.actors, self.replay_server = [], None
+        if args['mode'] == 'offline': # no actor, the replay buffer streams a recorded dataset
+            self.replay_buffer = OfflineReplayBufferAsync(*arg, **args)
+        elif args['replay_address'] is None:
+            self.actors = [ActorAsync(make_env_fun = make_env_fun, network_lock = self.network_lock, global_steps = self.global_steps, actor_id = actor_id, snapshots = self.snapshots, *arg, **args) for actor_id in range(self.num_actors)]
+            self.replay_buffer = self.replay_buffer_class(*arg, **args)
+        else:
+            self.actors = [ActorAsync(make_env_fun = make_env_fun, network_lock = self.network_lock, global_steps = self.global_steps, actor_id = actor_id, *arg, **args) for actor_id in range(self.num_actors)]
+            if not args['replay_external']: 
+                self.replay_server = ReplayServerAsync(*arg, **args)
+            self.replay_buffer = ReplayClient(**args)
+        self.recorder = DatasetRecorderAsync(**args) if args['record_dataset'] is not None else None
         self.evaluator = EvaluationAsync(make_env_fun = make_env_fun, **args)
+        startup_timer.mark('start_workers')
 
+        self.memory_monitor = MemoryMonitor(**args)
+        for actor in self.actors:
+            self.memory_monitor.register('actor_%d'%actor.actor_id, actor)
+        if self.replay_server is not None:
+            self.memory_monitor.register('replay_server', self.replay_server)
+        elif isinstance(self.replay_buffer, mp.Process): # not an external replay server
+            self.memory_monitor.register('replay_buffer', self.replay_buffer)
+        self.memory_monitor.register('evaluator', self.evaluator)
+        self.memory_monitor.register('logger', logger)
+        if self.recorder is not None: self.memory_monitor.register('recorder', self.recorder)
+        for process in self.actors + [self.replay_server, self.replay_buffer, self.evaluator]: # SIGUSR1 is forwarded to them
+            if isinstance(process, mp.Process): profiler.register(process)
+
+        self.env = make_env_fun(**game_args(0, **args)) # all games have the same spaces in the multi-task mode
+        if args['mode'] == 'offline': self.replay_buffer.check_observation_shape(self.env.observation_space.shape)
+        startup_timer.mark('make_env')
         self.current_network = netowrk_fun(self.env.observation_space.shape, self.env.action_space.n, **args).cuda().share_memory()
         self.target_network  = netowrk_fun(self.env.observation_space.shape, self.env.action_space.n, **args).cuda()
+        self.current_flat = FlatParameters(self.current_network)
+        self.target_flat = FlatParameters(self.target_network)
         self.optimizer = optimizer_fun(self.current_network.parameters())
-        self.update_target()
+        self.target_flat.copy_(self.current_flat)
+        if self.snapshots is not None: self.snapshots.allocate(self.current_flat)
         
-        self.evaluator.init(netowrk_fun)
+        self.evaluator.init(netowrk_fun, self.env.observation_space.shape, self.env.action_space.n)
+        startup_timer.mark('build_networks')
         
     def update_target(self):
-        self.target_network.load_state_dict(self.current_network.state_dict())
-    
-    def line_schedule(self, steps_idx):
-        eps = self.eps_end + (self.eps_start - self.eps_end) * (1 - min(steps_idx,self.eps_decay_steps) / self.eps_decay_steps)
-        return eps
+        if self.soft_update_tau is None:
+            self.target_flat.copy_(self.current_flat)
+        else:
+            self.target_flat.soft_update_(self.current_flat, self.soft_update_tau)
     
+    def report_memory(self):
+        if self.memory_monitor.due():
+            report, warning = self.memory_monitor.report()
+            logger.add(report)
+            if warning is not None:
+                logger.terminal_print('(Memory Warning)', {'memory': warning})
+
+    def add_transition(self, action, obs, reward, done, info, stream):
+        self.replay_buffer.add(action, obs[None,-1], reward, done, stream)
+        if self.recorder is not None:
+            self.recorder.add(action, obs[None,-1], reward, done, stream)
+
     def train(self):
         last_train_steps_idx, ep_idx = 1, 1
+        ep_steps = [0] * self.num_actors
         ep_reward_list = deque(maxlen=self.args['ep_reward_avg_number'])
+        if self.env_names is not None:
+            game_ep_reward_lists = [deque(maxlen=self.args['ep_reward_avg_number']) for _ in self.env_names]
         loss  = torch.tensor(0)
         tic   = time.time()
-        self.actor.set_network(self.current_network)
-        for train_steps_idx in range(1, self.args['train_steps'] + 1, self.args['train_freq']):
-            eps = self.line_schedule(train_steps_idx-self.start_training_steps) if train_steps_idx > self.start_training_steps else 1
-            data = self.actor.step(eps)
+        for actor in self.actors:
+            actor.set_network(self.current_network)
+        if self.snapshots is not None: self.snapshots.publish(self.current_flat, -1)
+        for loop_idx, train_steps_idx in enumerate(range(1, self.args['train_steps'] + 1, self.args['train_freq'])):
+            actor_id = loop_idx % self.num_actors # round robin, the other actors keep stepping meanwhile
+            with profiler.span('learner.actor_step_wait'):
+                data = self.actors[actor_id].step()
             for frames_idx, (action, obs, reward, done, info) in enumerate(data):
-                self.replay_buffer.add(action, obs[None,-1], reward, done)
+                self.add_transition(action, obs, reward, done, info, actor_id)
+                ep_steps[actor_id] += 1
                 if info is not None and info['episodic_return'] is not None:
-                    episodic_steps = train_steps_idx + frames_idx - last_train_steps_idx
                     ep_reward_list.append(info['episodic_return'])
                     toc = time.time()
-                    fps = episodic_steps / (toc-tic)
+                    fps = (train_steps_idx + frames_idx - last_train_steps_idx) / (toc-tic)
                     tic = time.time()
-                    logger.add({'train_steps':train_steps_idx ,'ep': ep_idx, 'ep_steps': episodic_steps, 'ep_reward': info['episodic_return'], 'ep_reward_avg': mean(ep_reward_list), 'loss': loss.item(), 'eps': eps, 'fps': fps})
+                    if self.env_names is not None: # actor i plays game i % num_games
+                        game = actor_id % len(self.env_names)
+                        game_ep_reward_lists[game].append(info['episodic_return'])
+                        logger.add({'ep_reward/' + self.env_names[game]: info['episodic_return'], 'ep_reward_avg/' + self.env_names[game]: mean(game_ep_reward_lists[game])})
+                    logger.add({'train_steps':train_steps_idx ,'ep': ep_idx, 'ep_steps': ep_steps[actor_id], 'ep_reward': info['episodic_return'], 'ep_reward_avg': mean(ep_reward_list), 'loss': loss.item(), 'eps': self.eps_schedules[actor_id](train_steps_idx), 'actor': actor_id, 'fps': fps})
                     logger.wandb_print('(Training Agent) ', step=train_steps_idx) if train_steps_idx > self.start_training_steps else logger.wandb_print('(Collecting Data) ', step=train_steps_idx)
                     ep_idx += 1
+                    ep_steps[actor_id] = 0
                     last_train_steps_idx = train_steps_idx + frames_idx
 
             if train_steps_idx > self.start_training_steps:
-                loss = self.compute_td_loss()
+                with profiler.span('learner.compute_td_loss'):
+                    loss = self.compute_td_loss()
 
-            if (train_steps_idx-1) % self.update_target_steps == 0:
+            if self.soft_update_tau is not None or (train_steps_idx-1) % self.update_target_steps == 0:
                 self.update_target()
+
+            if self.snapshots is not None: # weights after loop loop_idx, the copy is not waited for here
+                self.snapshots.publish(self.current_flat, loop_idx)
                 
             if (train_steps_idx-1) % self.eval_freq == 0:
-                self.evaluator.eval(train_steps=train_steps_idx, state_dict=self.current_network.state_dict())
+                self.evaluator.eval(train_steps=train_steps_idx, flat_params=self.current_flat)
+
+            self.report_memory()
+
+            if train_steps_idx == 1:
+                startup_timer.mark('first_step')
+                logger.terminal_print('(Startup Time)', startup_timer.report())
+
+        if self.recorder is not None:
+            self.recorder.close()
+
+    def train_offline(self):
+        '''
+        Train only from the dataset given by --offline_dataset, no env interaction
+        '''
+        tic = time.time()
+        for train_steps_idx in range(1, self.args['train_steps'] + 1, self.args['train_freq']):
+            with profiler.span('learner.compute_td_loss'):
+                loss = self.compute_td_loss()
+
+            if self.soft_update_tau is not None or (train_steps_idx-1) % self.update_target_steps == 0:
+                self.update_target()
+
+            if (train_steps_idx-1) % self.eval_freq == 0:
+                self.evaluator.eval(train_steps=train_steps_idx, flat_params=self.current_flat)
+
+            self.report_memory()
+
+            if (train_steps_idx-1) % self.args['offline_log_freq'] == 0:
+                toc = time.time()
+                logger.add({'train_steps': train_steps_idx, 'loss': loss.item(), 'updates_per_sec': self.args['offline_log_freq'] / self.args['train_freq'] / (toc-tic)})
+                logger.wandb_print('(Offline Training) ', step=train_steps_idx)
+                tic = time.time()
 
 
 # %%
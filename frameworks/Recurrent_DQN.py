@@ -0,0 +1,60 @@
+#%%
+'''
+R2D2 style recurrent DQN: sequence replay with stored recurrent state and burn in, no frame stacking
+'''
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from utils.Network import *
+from utils.LogAsync import logger
+from utils.SequenceReplayBufferAsync import SequenceReplayBufferAsync
+from frameworks.Nature_DQN import Nature_DQN
+
+class Recurrent_DQN(Nature_DQN):
+    replay_buffer_class = SequenceReplayBufferAsync
+
+    def __init__(self, make_env_fun, network_fun, optimizer_fun, *arg, **args):
+        if args['env_names'] is not None: raise Exception('--env_names is not supported with sequence replay')
+        if args['replay_address'] is not None: raise Exception('--replay_address is not supported with sequence replay, the replay service stores frame stacked transitions')
+        if args['stack_frames'] != 1: raise Exception('Sequence replay needs --stack_frames 1, the LSTM keeps the history')
+        super().__init__(make_env_fun, network_fun, optimizer_fun, *arg, **args)
+        self.burn_in = args['burn_in']
+
+    def add_transition(self, action, obs, reward, done, info, stream):
+        recurrent_state = None if info is None else info['recurrent_state']
+        self.replay_buffer.add(action, obs[None,-1], reward, done, stream, recurrent_state)
+        if self.recorder is not None:
+            self.recorder.add(action, obs[None,-1], reward, done, stream)
+
+    def compute_td_loss(self):
+        obs, action, reward, done, valid, first, recurrent_state = self.replay_buffer.sample()
+        h, c = recurrent_state.chunk(2, dim=-1)
+        state = (h.contiguous(), c.contiguous())
+        burn_in = self.burn_in
+
+        with torch.no_grad():
+            q_next_target, _ = self.target_network.forward_sequence(obs, state, first)
+            q_next_target = q_next_target[:, burn_in+1:]
+            if burn_in > 0:
+                _, state = self.current_network.forward_sequence(obs[:, :burn_in], state, first[:, :burn_in])
+
+        q_value, _ = self.current_network.forward_sequence(obs[:, burn_in:], state, first[:, burn_in:])
+        with torch.no_grad():
+            a_next = torch.argmax(q_value[:, 1:], dim=-1) # double DQN
+            q_next = q_next_target.gather(-1, a_next.unsqueeze(-1)).squeeze(-1)
+            q_target = reward[:, burn_in:] + self.gamma * (~done[:, burn_in:]) * q_next
+        q_value = q_value[:, :-1].gather(-1, action[:, burn_in:].unsqueeze(-1)).squeeze(-1)
+
+        mask = valid[:, burn_in:].float()
+        loss = (F.smooth_l1_loss(q_value, q_target, reduction='none') * mask).sum() / mask.sum().clamp(min=1)
+
+        self.optimizer.zero_grad()
+        loss.backward()
+        gradient_norm = nn.utils.clip_grad_norm_(self.current_network.parameters(), self.gradient_clip)
+        logger.add({'gradient_norm': gradient_norm.item()})
+        with self.network_lock:
+            self.optimizer.step()
+
+        return loss
+
+# %%
@@ -1,12 +1,11 @@
-import random
+from utils.StartupTimer import startup_timer
 import torch
 from utils.Network import *
-from utils.Config import get_default_parser
-import numpy as np
+from utils.Config import get_default_parser, init_main
 from utils.Wrapper import make_env
 from utils.LogAsync import logger
 from frameworks.C51_DQN import C51_DQN
-
+startup_timer.mark('imports')
 
 
 if __name__ == '__main__':
@@ -18,23 +17,27 @@ if __name__ == '__main__':
     
     parser.set_defaults(eval_render_save_video=[1]) # save 1 and 5
     args = parser.parse_args()
-    torch.manual_seed(args.seed)
-    torch.cuda.manual_seed(args.seed)
-    random.seed(args.seed)
-    np.random.seed(args.seed)
+    init_main(args)
     logger.init(project_name='C51', args=args)
 
     if args.mode == 'train':
         C51_DQN(
             make_env_fun = make_env,
-            network_fun = CatCnnQNetwork, 
+            network_fun = CatCnnQNetwork if args.env_names is None else MultiTaskCatCnnQNetwork, 
             optimizer_fun = lambda params: torch.optim.Adam(params, lr=args.lr, eps=args.opt_eps),  
             **vars(args)
             ).train()
-    elif args.mode == 'eval':
+    elif args.mode == 'offline':
         C51_DQN(
             make_env_fun = make_env,
             network_fun = CatCnnQNetwork, 
             optimizer_fun = lambda params: torch.optim.Adam(params, lr=args.lr, eps=args.opt_eps),  
             **vars(args)
+            ).train_offline()
+    elif args.mode == 'eval':
+        C51_DQN(
+            make_env_fun = make_env,
+            network_fun = CatCnnQNetwork if args.env_names is None else MultiTaskCatCnnQNetwork, 
+            optimizer_fun = lambda params: torch.optim.Adam(params, lr=args.lr, eps=args.opt_eps),  
+            **vars(args)
             ).eval()
\ No newline at end of file
@@ -0,0 +1,32 @@
+from utils.StartupTimer import startup_timer
+import torch
+from utils.Network import *
+from utils.Config import get_default_parser, init_main
+from utils.Wrapper import make_env
+from utils.LogAsync import logger
+from frameworks.Recurrent_DQN import Recurrent_DQN
+startup_timer.mark('imports')
+
+
+if __name__ == '__main__':
+    parser = get_default_parser()
+    parser.set_defaults(seed=555) 
+    parser.set_defaults(env_name= 'BreakoutNoFrameskip-v4')
+    # parser.set_defaults(env_name= 'SpaceInvadersNoFrameskip-v4')
+    # parser.set_defaults(env_name= 'PongNoFrameskip-v4')
+    
+    parser.set_defaults(eval_render_save_video=[1]) # save 1 and 5
+    parser.set_defaults(stack_frames=1)
+    args = parser.parse_args()
+    init_main(args)
+    logger.init(project_name='R2D2', args=args)
+
+    if args.mode == 'train':
+        Recurrent_DQN(
+            make_env_fun = make_env,
+            network_fun = RecurrentCnnQNetwork, 
+            optimizer_fun = lambda params: torch.optim.Adam(params, lr=args.lr, eps=args.opt_eps),  
+            **vars(args)
+            ).train()
+    else:
+        raise Exception('main_recurrent.py only supports --mode train')
\ No newline at end of file
@@ -0,0 +1,51 @@
+import os
+import threading
+import tempfile
+import pytest
+np = pytest.importorskip('numpy')
+pytest.importorskip('torch')
+pytest.importorskip('gym')
+from utils.ReplayServiceAsync import ReplayServerAsync, ReplayClient
+
+def make_args(address):
+    # full size frames and the default batches, so that a sample reply and an insert batch are both
+    # larger than the unix socket buffer
+    return {'replay_address': address, 'replay_external': False, 'buffer_size': 10000, 'stack_frames': 4, 'seed': 0,
+        'batch_size': 32, 'replay_insert_batch': 64, 'replay_max_inflight': 1, 'replay_prefetch': 8,
+        'profile': False, 'profile_dir': None, 'profile_window': None}
+
+def test_prefetched_samples_interleaved_with_full_flushes():
+    address = os.path.join(tempfile.mkdtemp(), 'replay.sock')
+    args = make_args(address)
+    server = ReplayServerAsync(**args)
+    client = ReplayClient(device=None, **args)
+    errors = []
+
+    def train():
+        try:
+            frame = np.zeros((1, 84, 84), dtype=np.uint8)
+            client.add(None, frame, None, None)
+            for step in range(200): # enough for the first sample
+                client.add(step % 4, frame, 1., False)
+            client.flush()
+            for _ in range(50):
+                state, action, reward, next_state, done = client.sample() # leaves a prefetch reply outstanding
+                assert state.shape == (4, 84, 84)
+                for step in range(2 * args['replay_insert_batch']): # full size flushes while the reply is pending
+                    client.add(step % 4, frame, 1., False)
+            assert client.stats()['inserted'] >= 200
+        except Exception as e:
+            errors.append(e)
+
+    trainer = threading.Thread(target=train, daemon=True)
+    trainer.start()
+    trainer.join(timeout=120)
+    deadlocked = trainer.is_alive()
+    if not deadlocked:
+        client.shutdown()
+        client.close()
+        server.join(timeout=10)
+    else:
+        server.terminate()
+    assert not deadlocked, 'client and server deadlocked'
+    assert errors == []
@@ -2,78 +2,123 @@ import torch
 import numpy as np
 import torch.multiprocessing as mp
 import random 
-from baselines.common.atari_wrappers import EpisodicLifeEnv
+import time
+import copy
+from utils.StartupTimer import startup_timer
+from utils.Exploration import EpsilonSchedule
+from utils.ParameterSync import FlatParameters
+from utils.Profiler import profiler
+from utils.Wrapper import num_games, game_args
 
 class ActorAsync(mp.Process):
     STEP = 0
     EXIT = 1
     NETWORK = 2
-    def __init__(self, env, network_lock, *arg, **args):
+    def __init__(self, make_env_fun, network_lock, global_steps, actor_id, snapshots=None, *arg, **args):
+        '''
+        global_steps is a shared counter of the frames of all actors, the epsilon schedule is a function of it
+        snapshots (VersionedSnapshots) is given in the deterministic mode, see eps_greedy_step
+        '''
         mp.Process.__init__(self)
-        self.seed = args['seed']
+        self.actor_id = actor_id
+        self.seed = args['seed'] + actor_id
+        self.global_steps = global_steps
+        self.eps_schedule = EpsilonSchedule(actor_id, **args)
+        self.num_actors = args['num_actors']
+        self.snapshots = snapshots
+        self.request_idx = actor_id # index of the learner loop in which the next step is requested (round robin)
         self.__pipe, self.__worker_pipe = mp.Pipe()
-        self.env = env
+        self.make_env_fun = make_env_fun
+        self.game = actor_id % num_games(**args) # multi-task mode, the games are spread over the actors
+        self.args = game_args(self.game, **args)
         self.is_init_cache = False
         self.network_lock = network_lock
         self.steps_no = args['train_freq']
         self.done = True
+        self.ready_time = startup_timer.register('actor_%d'%actor_id)
         self.start()
 
     def init_seed(self):
         torch.manual_seed(self.seed)
         torch.cuda.manual_seed(self.seed)
+        if self.snapshots is not None: torch.backends.cudnn.deterministic = True
         random.seed(self.seed)
         np.random.seed(self.seed)
         self.env.seed(self.seed)
         self.env.action_space.np_random.seed(self.seed)
 
     def run(self):
+        profiler.init('actor_%d'%self.actor_id, **self.args)
+        self.env = self.make_env_fun(**self.args) # build the env in the worker, in parallel with the other processes
         self.init_seed()
+        self.ready_time.value = time.time()
         while True:
             cmd, data = self.__worker_pipe.recv()
             if cmd == self.STEP:
-                eps = data
                 if not self.is_init_cache:
                     self.is_init_cache = True
-                    self.__worker_pipe.send(self.eps_greedy_step(eps))
-                    self.cache = self.eps_greedy_step(eps)
+                    with profiler.span('actor.eps_greedy_step'):
+                        self.__worker_pipe.send(self.eps_greedy_step(self.request_idx))
                 else:
                     self.__worker_pipe.send(self.cache)
-                    self.cache = self.eps_greedy_step(eps)
+                self.request_idx += self.num_actors
+                with profiler.span('actor.eps_greedy_step'):
+                    self.cache = self.eps_greedy_step(self.request_idx) # served at the next request of this actor
 
             elif cmd == self.EXIT:
                 self.__worker_pipe.close()
                 return
 
             elif cmd == self.NETWORK:
-                self._network = data
+                if self.snapshots is None:
+                    self._network = data
+                else: # act with a private copy which is loaded with an exact weights version
+                    network, snapshots_shared = data
+                    self._network = copy.deepcopy(network)
+                    self.network_flat = FlatParameters(self._network)
+                    self.snapshots.attach(*snapshots_shared)
+                self._network.game = self.game # process local, the learner's network is not affected
 
             else:
                 raise NotImplementedError
 
-    def eps_greedy_step(self, eps):
+    def eps_greedy_step(self, request_idx):
+        '''
+        Steps served at the learner loop *request_idx*
+        In the deterministic mode, the steps are a pure function of the seed and request_idx:
+        epsilon comes from the logical step of the learner, and the weights are the version published
+        at the end of learner loop request_idx - num_actors - 1, which is the last loop finished before
+        the learner requested the previous steps of this actor. It is available as soon as these steps
+        start, so acting still overlaps with learning.
+        '''
+        if self.snapshots is None:
+            with self.global_steps.get_lock():
+                self.global_steps.value += self.steps_no
+                eps = self.eps_schedule(self.global_steps.value)
+        else:
+            eps = self.eps_schedule(1 + request_idx * self.steps_no)
+            self.snapshots.read(self.network_flat, max(request_idx - self.num_actors - 1, -1))
         # auto reset
         data = []
-        for _ in range(self.steps_no):
+        for step_idx in range(self.steps_no):
             if self.done:
                 self.state = self.env.reset()
+                if self._network.recurrent: self._network.reset_hidden()
                 data.append([None, self.state, None, None, None])
                 self.done = False
                 continue
-            eps_prob =  random.random()
-            if eps_prob > eps:
-                with self.network_lock:
-                    action = self._network.act(np.array(self.state, copy=False))
-            else:
-                action = self.env.action_space.sample()
+            if self._network.recurrent: recurrent_state = self._network.recurrent_state() # before this frame
+            with self.network_lock:
+                action = self._network.act(np.array(self.state, copy=False), eps)
 
             obs, reward, self.done, info = self.env.step(action)
+            if self._network.recurrent: info['recurrent_state'] = recurrent_state
             data.append([action, obs, reward, self.done, info])
             self.state = obs
         return data
 
-    def step(self, eps):
-        self.__pipe.send([self.STEP, eps])
+    def step(self):
+        self.__pipe.send([self.STEP, None])
         return self.__pipe.recv()
 
     def close(self):
@@ -81,4 +126,4 @@ class ActorAsync(mp.Process):
         self.__pipe.close()
 
     def set_network(self, net):
-        self.__pipe.send([self.NETWORK, net])
\ No newline at end of file
+        self.__pipe.send([self.NETWORK, net if self.snapshots is None else [net, self.snapshots.shared()]])
\ No newline at end of file
@@ -14,17 +14,53 @@ def get_default_parser():
     parser.add_argument('--eps_start', type=int, default=1)
     parser.add_argument('--eps_end', type=int, default=0.01)
     parser.add_argument('--eps_decay_steps', type=int, default=int(1e6))
+    parser.add_argument('--eps_mode', type=str, default='linear', choices=['linear', 'apex'], help="linear: decay from eps_start to eps_end. apex: constant per actor epsilons apex_eps_base ** (1 + i / (num_actors - 1) * apex_eps_alpha).")
+    parser.add_argument('--apex_eps_base', type=float, default=0.4)
+    parser.add_argument('--apex_eps_alpha', type=float, default=7.)
+    parser.add_argument('--num_actors', type=int, default=1, help="Actor processes, stepped in round robin by the learner.")
     parser.add_argument('--buffer_size', type=int, default=int(1e6))
     parser.add_argument('--env_name', type=str, default='BreakoutNoFrameskip-v4')
+    parser.add_argument('--env_names', type=str, nargs='+', default=None, help="Multi-task mode: actor i plays env_names[i % len(env_names)] with the full action space, one network with a head per game. Overrides env_name.")
+    parser.add_argument('--task_sample_weights', type=float, nargs='+', default=None, help="Share of every game of env_names in a training batch (normalized), uniform if not given.")
     parser.add_argument('--stack_frames', type=int, default=4)
     parser.add_argument('--train_steps', type=int, default=int(5e7))
     parser.add_argument('--start_training_steps', type=int, default=50000)
     parser.add_argument('--train_freq', type=int, default=4)
     parser.add_argument('--update_target_steps', type=int, default=40000)
-    parser.add_argument('--mode', type=str, default='train') # eval
+    parser.add_argument('--soft_update_tau', type=float, default=None, help="If given, Polyak average the target network with rate *soft_update_tau* every training step instead of copying every *update_target_steps*.")
+    parser.add_argument('--mode', type=str, default='train') # eval, offline
     parser.add_argument('--model_path', type=str, default = None)
     parser.add_argument('--ep_reward_avg_number', type=int, default = 10)
+    parser.add_argument('--start_method', type=str, default='fork', choices=['fork', 'forkserver', 'spawn'], help="Start method of the worker processes. forkserver and spawn do not copy the learner, each worker imports only what it needs.")
+    parser.add_argument('--deterministic', action='store_true', help="Reproducible runs: the actors act with the weights version of their logical step instead of the latest one, and deterministic CUDA kernels are used.")
     
+    # Profiling
+    parser.add_argument('--profile', action='store_true', help="Install the profiler in every process. Send SIGUSR1 to the main process to capture *profile_window* seconds in all of them, then merge with `python -m utils.Profiler <profile_dir>`.")
+    parser.add_argument('--profile_dir', type=str, default='profile', help="Folder of the per process spans and torch.profiler traces.")
+    parser.add_argument('--profile_window', type=float, default=5, help="Seconds captured per SIGUSR1.")
+
+    # Memory
+    parser.add_argument('--memory_budget', type=float, default=None, help="Memory budget in GB of the whole process graph. If given, the replay capacity is reduced to fit (or spilled to *replay_spill_dir*).")
+    parser.add_argument('--memory_per_process', type=float, default=1.0, help="Estimated GB of every process besides the replay storage (torch, CUDA context, env), used with *memory_budget*.")
+    parser.add_argument('--replay_spill_dir', type=str, default=None, help="If the replay buffer does not fit in *memory_budget*, memory map it in this folder instead of reducing it (sequence replay only).")
+    parser.add_argument('--memory_report_secs', type=float, default=60, help="Every *memory_report_secs* seconds, log the memory of every process.")
+    parser.add_argument('--memory_warn_fraction', type=float, default=0.9, help="Warn when the memory usage is above this fraction of the limit.")
+
+    # Replay service
+    parser.add_argument('--replay_address', type=str, default=None, help="If given, the replay buffer is served on this unix socket path, so that several learners and offline tools can share it.")
+    parser.add_argument('--replay_external', action='store_true', help="Connect to a replay server already running on *replay_address* instead of starting one.")
+    parser.add_argument('--replay_insert_batch', type=int, default=64, help="Transitions per insert request to the replay server.")
+    parser.add_argument('--replay_max_inflight', type=int, default=4, help="Unacknowledged insert requests before the client blocks (backpressure).")
+    parser.add_argument('--replay_prefetch', type=int, default=4, help="Batches per sample request to the replay server.")
+
+    # Offline dataset
+    parser.add_argument('--record_dataset', type=str, default=None, help="If given, the actor transitions are also recorded to this folder as a chunked compressed dataset.")
+    parser.add_argument('--dataset_chunk_steps', type=int, default=10000, help="Steps per dataset chunk (chunks are cut at the next reset).")
+    parser.add_argument('--offline_dataset', type=str, default=None, help="Dataset folder used by --mode offline.")
+    parser.add_argument('--dataset_prefetch_chunks', type=int, default=2, help="Chunks decompressed ahead of the replay buffer in --mode offline.")
+    parser.add_argument('--offline_ingest_steps', type=int, default=4, help="Dataset steps added to the replay buffer before each sample in --mode offline.")
+    parser.add_argument('--offline_log_freq', type=int, default=10000, help="Every *offline_log_freq* training steps, log in --mode offline.")
+
     # Evaluation
     parser.add_argument('--eval_steps', type=int, default=18000, help="The maximum steps for each episode in evaluation.")
     parser.add_argument('--eval_freq', type=int, default=int(1e6), help="Every *eval_freq* training steps, Evaluate the model.")
@@ -34,8 +70,41 @@ def get_default_parser():
     parser.add_argument('--eval_render_freq', type=int, default=1, help="Every *eval_render_freq* evaluation steps, render the frames.")
     parser.add_argument('--eval_render_save_video', type=tuple, default=None, help="If None, then save all episode in gif, otherwise, \"1 10\" means only 1st and 10th episodes are saved. Notably, saving gif can be very slow!") # 
 
+    # Network
+    parser.add_argument('--dueling', action='store_true', help="Dueling head (value and advantage streams).")
+    parser.add_argument('--noisy', action='store_true', help="NoisyNet head. Exploration comes from the noisy layers, epsilon is ignored by the actor.")
+
+    # Recurrent (R2D2)
+    parser.add_argument('--recurrent_hidden_size', type=int, default=512, help="LSTM size of the recurrent Q network.")
+    parser.add_argument('--burn_in', type=int, default=40, help="Steps at the start of each replayed sequence used only to rebuild the recurrent state.")
+    parser.add_argument('--sequence_length', type=int, default=80, help="Trained steps of each replayed sequence (after burn in).")
+    parser.add_argument('--sequence_stride', type=int, default=40, help="A sequence starts every *sequence_stride* steps, consecutive sequences overlap.")
+
     # C51
     parser.add_argument('--num_atoms', type=int, default=51)
     parser.add_argument('--v_min', type=float, default=-10.)
     parser.add_argument('--v_max', type=float, default=10.)
     return parser
+
+def init_main(args):
+    '''
+    Process graph setup shared by the entry points: start method, seeds and the deterministic mode
+    Must be called in the main process before any worker is constructed
+    '''
+    import os
+    import random
+    import numpy as np
+    import torch
+    import torch.multiprocessing as mp
+    mp.set_start_method(args.start_method)
+    if args.start_method == 'forkserver': # the forkserver imports only what every worker needs, the rest is imported lazily per worker
+        mp.set_forkserver_preload(['torch', 'numpy', 'gym', 'utils.Wrapper'])
+    torch.manual_seed(args.seed)
+    torch.cuda.manual_seed(args.seed)
+    if args.deterministic:
+        os.environ['CUBLAS_WORKSPACE_CONFIG'] = ':4096:8' # inherited by the workers
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+        torch.use_deterministic_algorithms(True, warn_only=True)
+    random.seed(args.seed)
+    np.random.seed(args.seed)
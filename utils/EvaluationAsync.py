@@ -5,13 +5,13 @@ import torch.multiprocessing as mp
 from statistics import mean
 from utils.LogAsync import logger
 import time
-import matplotlib
-import matplotlib.pyplot as plt
-from matplotlib import gridspec
 from collections import deque
 import os
 from datetime import datetime
-import imageio
+from utils.ParameterSync import FlatParameters, DoubleBufferHandoff
+from utils.StartupTimer import startup_timer
+from utils.Profiler import profiler
+from utils.Wrapper import num_games, game_args
 
 class EvaluationAsync(mp.Process):
     EVAL = 0
@@ -23,43 +23,49 @@ class EvaluationAsync(mp.Process):
         self.make_env_fun = make_env_fun
         self.args = args
         self.__pipe, self.__worker_pipe = mp.Pipe()
-        self.evaluator_lock = mp.Lock()
+        self.handoff = DoubleBufferHandoff()
         self.seed = args['seed']
+        self.num_games = num_games(**args)
+        self.eval_args = args
+        self.log_connection = logger.connection()
+        self.ready_time = startup_timer.register('evaluator')
         self.start()
 
     def _eval(self, ep_idx):
-        env = self.make_env_fun(**self.args)
+        env = self.make_env_fun(**self.eval_args)
         env.seed(self.seed+ep_idx)
         env.action_space.np_random.seed(self.seed+ep_idx)
         state = env.reset()
+        if self.evaluator_network.recurrent: self.evaluator_network.reset_hidden()
         tic   = time.time()
         for eval_steps_idx in range(1, self.eval_steps + 1):
-            eps_prob =  random.random()
-            action = self.evaluator_network.act(state) if eps_prob > self.eval_eps else env.action_space.sample()
+            action = self.evaluator_network.act(state, self.eval_eps)
             state, _, done, info = env.step(action)
             if (ep_idx is None or ep_idx in self.eval_render_save_video) and \
                 (eval_steps_idx-1) % self.eval_render_freq == 0 : # every eval_render_freq frames sample 1 frame
                 self._render_frame(env, state, action)
             if done:
                 state = env.reset()
+                if self.evaluator_network.recurrent: self.evaluator_network.reset_hidden()
                 if info['episodic_return'] is not None: break
         toc = time.time()
         fps = eval_steps_idx / (toc-tic)
         return eval_steps_idx, info['total_rewards'], fps
 
     def _render_frame(self, env, state, action):
-        action_prob = np.swapaxes(self.evaluator_network.action_prob[0].cpu().numpy(),0, 1)
-        legends = []
-        for i, action_meaning in enumerate(env.unwrapped.get_action_meanings()):
-            legend_text = ' (Q=%+.2e)'%(self.evaluator_network.action_Q[0,i]) if i == action else ' (Q=%+.2e)*'%(self.evaluator_network.action_Q[0,i])
-            legends.append(action_meaning + legend_text) 
         self.ax_left.clear()
         self.ax_left.imshow(state[-1])
         self.ax_left.axis('off')
         self.ax_right.clear()
-        self.ax_right.plot(self.atoms_cpu, action_prob)
-        self.ax_right.legend(legends)
-        self.ax_right.grid(True)
+        if hasattr(self.evaluator_network, 'action_prob'): # categorical networks only
+            action_prob = np.swapaxes(self.evaluator_network.action_prob[0].cpu().numpy(),0, 1)
+            legends = []
+            for i, action_meaning in enumerate(env.unwrapped.get_action_meanings()):
+                legend_text = ' (Q=%+.2e)'%(self.evaluator_network.action_Q[0,i]) if i == action else ' (Q=%+.2e)*'%(self.evaluator_network.action_Q[0,i])
+                legends.append(action_meaning + legend_text) 
+            self.ax_right.plot(self.atoms_cpu, action_prob)
+            self.ax_right.legend(legends)
+            self.ax_right.grid(True)
         self.my_fig.canvas.draw()
         buf = self.my_fig.canvas.tostring_rgb()
         self.writer.append_data(np.fromstring(buf, dtype=np.uint8).reshape(self.fig_pixel_rows, self.fig_pixel_cols, 3))
@@ -71,13 +77,19 @@ class EvaluationAsync(mp.Process):
         np.random.seed(self.seed)
 
     def run(self):
+        import matplotlib # plotting and video writing are only needed in the evaluation process
+        if not self.args['eval_display']: matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from matplotlib import gridspec
+        import imageio
+        logger.attach(self.log_connection)
+        profiler.init('evaluator', **self.args)
         self.init_seed()
         self.eval_steps = self.args['eval_steps']
         self.eval_number = self.args['eval_number']
         self.eval_render_freq = self.args['eval_render_freq']
         self.eval_eps = self.args['eval_eps']
         self.eval_render_save_video = None if self.args['eval_render_save_video'] is None else [int(i) for i in self.args['eval_render_save_video']]
-        if not self.args['eval_display']: matplotlib.use('Agg')
         self.my_fig = plt.figure(figsize=(10, 5), dpi=160)
         plt.rcParams['font.size'] = '8'
         gs = gridspec.GridSpec(1, 2)
@@ -87,39 +99,58 @@ class EvaluationAsync(mp.Process):
         self.fig_pixel_cols, self.fig_pixel_rows = self.my_fig.canvas.get_width_height()
         self.atoms_cpu = torch.linspace(self.args['v_min'], self.args['v_max'], self.args['num_atoms'])
         video_fps = 60/4/self.args['eval_render_freq']
+        last_train_steps = None
+        best_ep_rewards_list_mean = float('-inf')
+        eval_round, last_game_rewards = 0, dict() # multi-task mode: one game per round, in rotation
+        self.ready_time.value = time.time()
 
         while True:
             cmd, data = self.__worker_pipe.recv()
             if cmd == self.EVAL:
-                with self.evaluator_lock:
-                    current_train_steps = data
-                    ep_rewards_list = deque(maxlen=self.eval_number)
-                    for ep_idx in range(1, self.eval_number+1):
-                        self.writer = imageio.get_writer(self.gif_folder + '%08d_%03d.mp4'%(current_train_steps, ep_idx), fps = video_fps)
+                current_train_steps = self.handoff.pull(self.evaluator_flat)
+                if current_train_steps == last_train_steps: continue # weights already evaluated, requests were queued while evaluating
+                last_train_steps = current_train_steps
+                game = eval_round % self.num_games
+                eval_round += 1
+                self.eval_args = game_args(game, **self.args)
+                self.evaluator_network.game = game
+                video_prefix = '' if self.num_games == 1 else self.eval_args['env_name'] + '_'
+                ep_rewards_list = deque(maxlen=self.eval_number)
+                for ep_idx in range(1, self.eval_number+1):
+                    self.writer = imageio.get_writer(self.gif_folder + video_prefix + '%08d_%03d.mp4'%(current_train_steps, ep_idx), fps = video_fps)
+                    with profiler.span('evaluator.eval'):
                         eval_steps_idx, ep_rewards, fps = self._eval(ep_idx)
-                        self.writer.close()
-                        ep_rewards_list.append(ep_rewards)
-                        ep_rewards_list_mean = mean(ep_rewards_list)
-                        logger.terminal_print('--------(Evaluating Agent: %d)'%(current_train_steps), {
-                            '--------ep': ep_idx, 
-                            '--------ep_steps':  eval_steps_idx, 
-                            '--------ep_reward': ep_rewards, 
-                            '--------ep_reward_mean': ep_rewards_list_mean, 
-                            '--------fps': fps})
-                    logger.add({'eval_last': ep_rewards_list_mean})
-                    if current_train_steps == 1 or ep_rewards_list_mean >= best_ep_rewards_list_mean:
-                        torch.save(self.evaluator_network.state_dict(), 'save_model/' + self.evaluator_name + '.pt')
-                        best_ep_rewards_list_mean = ep_rewards_list_mean
-                        logger.add({'eval_best': best_ep_rewards_list_mean})
+                    self.writer.close()
+                    ep_rewards_list.append(ep_rewards)
+                    ep_rewards_list_mean = mean(ep_rewards_list)
+                    logger.terminal_print('--------(Evaluating Agent: %d)'%(current_train_steps), {
+                        '--------ep': ep_idx, 
+                        '--------ep_steps':  eval_steps_idx, 
+                        '--------ep_reward': ep_rewards, 
+                        '--------ep_reward_mean': ep_rewards_list_mean, 
+                        '--------fps': fps})
+                if self.num_games > 1: # the best model is the one with the best mean over the last evaluation of every game
+                    logger.add({'eval_last/' + self.eval_args['env_name']: ep_rewards_list_mean})
+                    last_game_rewards[game] = ep_rewards_list_mean
+                    if len(last_game_rewards) < self.num_games: continue
+                    ep_rewards_list_mean = mean(last_game_rewards.values())
+                logger.add({'eval_last': ep_rewards_list_mean})
+                if ep_rewards_list_mean >= best_ep_rewards_list_mean:
+                    torch.save(self.evaluator_network.state_dict(), 'save_model/' + self.evaluator_name + '.pt')
+                    best_ep_rewards_list_mean = ep_rewards_list_mean
+                    logger.add({'eval_best': best_ep_rewards_list_mean})
 
             elif cmd == self.EXIT:
                 self.__worker_pipe.close()
                 return 
 
             elif cmd == self.NETWORK:
-                self.evaluator_network = data
+                self.evaluator_network, handoff_buffer = data
+                self.evaluator_flat = FlatParameters(self.evaluator_network)
+                self.evaluator_network.eval() # mean weights for noisy networks
+                self.handoff.attach(handoff_buffer)
                 now = datetime.now()
-                self.evaluator_name = self.evaluator_network.__class__.__name__ + '(' + self.args['env_name'] + ')_%d_'%self.args['seed'] + now.strftime("%Y%m%d-%H%M%S")
+                self.evaluator_name = self.evaluator_network.__class__.__name__ + '(' + '+'.join(self.args['env_names'] or [self.args['env_name']]) + ')_%d_'%self.args['seed'] + now.strftime("%Y%m%d-%H%M%S")
                 self.gif_folder = 'save_video/' + self.evaluator_name + '/'
                 if not os.path.exists(self.gif_folder):
                     os.makedirs(self.gif_folder)
@@ -129,19 +160,22 @@ class EvaluationAsync(mp.Process):
             else:
                 raise NotImplementedError
 
-    def init(self, netowrk_fun): 
-        temp_env = self.make_env_fun(**self.args)
-        self.evaluator_network  = netowrk_fun(temp_env.observation_space.shape, temp_env.action_space.n, **self.args).cuda().share_memory()
-        self.__pipe.send([self.NETWORK, self.evaluator_network]) # pass network to the evaluation process
+    def init(self, netowrk_fun, observation_shape, num_actions): 
+        self.evaluator_network  = netowrk_fun(observation_shape, num_actions, **self.args).cuda().share_memory()
+        self.evaluator_flat = FlatParameters(self.evaluator_network)
+        handoff_buffer = self.handoff.allocate(self.evaluator_flat)
+        self.__pipe.send([self.NETWORK, [self.evaluator_network, handoff_buffer]]) # pass network and weight buffers to the evaluation process
 
-    def eval(self, train_steps = 0, state_dict = None):
-        with self.evaluator_lock:
-            if self.args['mode'] == 'eval': # if this is only an evaluation session, then load model first
-                if self.args['model_path'] is None: raise Exception("Model Path for Evaluation is not given! Include --model_path")
-                self.evaluator_network.load_state_dict(torch.load(self.args['model_path']))
-            else:
-                self.evaluator_network.load_state_dict(state_dict)
-            self.__pipe.send([self.EVAL, train_steps])
+    def eval(self, train_steps = 0, flat_params = None):
+        '''
+        Never blocks on a running evaluation, the evaluator picks up the latest published weights when it is free
+        '''
+        if self.args['mode'] == 'eval': # if this is only an evaluation session, then load model first
+            if self.args['model_path'] is None: raise Exception("Model Path for Evaluation is not given! Include --model_path")
+            self.evaluator_network.load_state_dict(torch.load(self.args['model_path']))
+            flat_params = self.evaluator_flat
+        self.handoff.publish(flat_params, train_steps)
+        self.__pipe.send([self.EVAL, None])
 
     def exit(self):
         self.__pipe.send([self.EXIT, None])
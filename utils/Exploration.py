@@ -0,0 +1,27 @@
+class EpsilonSchedule:
+    '''
+    Epsilon of one actor as a function of the global step, computed on the actor side
+    linear  decay from eps_start to eps_end in eps_decay_steps after start_training_steps (Nature DQN)
+    apex    constant eps_i = apex_eps_base ** (1 + i / (num_actors - 1) * apex_eps_alpha) for actor i (Ape-X)
+    Before start_training_steps epsilon is 1 in both cases
+    '''
+    def __init__(self, actor_id = 0, **args):
+        self.eps_start = args['eps_start']
+        self.eps_end = args['eps_end']
+        self.eps_decay_steps = args['eps_decay_steps']
+        self.start_training_steps = args['start_training_steps']
+        self.eps_mode = args['eps_mode']
+        num_actors = args['num_actors']
+        if self.eps_mode == 'apex':
+            exponent = 1 + actor_id / (num_actors - 1) * args['apex_eps_alpha'] if num_actors > 1 else 1
+            self.apex_eps = args['apex_eps_base'] ** exponent
+        elif self.eps_mode != 'linear':
+            raise NotImplementedError
+
+    def __call__(self, steps_idx):
+        if steps_idx <= self.start_training_steps:
+            return 1
+        if self.eps_mode == 'apex':
+            return self.apex_eps
+        steps_idx = min(steps_idx - self.start_training_steps, self.eps_decay_steps)
+        return self.eps_end + (self.eps_start - self.eps_end) * (1 - steps_idx / self.eps_decay_steps)
@@ -1,8 +1,9 @@
 import torch
 import numpy as np
 import torch.multiprocessing as mp
-import wandb
 import json
+import time
+from utils.StartupTimer import startup_timer
 
 class Singleton(type):
     _instances = {}
@@ -27,14 +28,17 @@ class LogAsync(mp.Process, metaclass=Singleton):
         self. args = args
         self.__pipe, self.__worker_pipe = mp.Pipe()
         self.log_dict = dict()
+        self.ready_time = startup_timer.register('logger')
         self.start()
 
     def run(self):
+        import wandb # only the log process needs wandb
         if self.project_name is not None:
-            wandb.init(name='CatCnnDQN(' + self.args.env_name + ')_' + str(self.args.seed), project=self.project_name, config=self.args)
+            wandb.init(name='CatCnnDQN(' + '+'.join(self.args.env_names or [self.args.env_name]) + ')_' + str(self.args.seed), project=self.project_name, config=self.args)
             self.wandb_init = True
         else:
             self.wandb_init = False
+        self.ready_time.value = time.time()
         while True:
             cmd, data = self.__worker_pipe.recv()
             if cmd == self.ADD:
@@ -72,6 +76,16 @@ class LogAsync(mp.Process, metaclass=Singleton):
             else:
                 raise NotImplementedError
 
+    def connection(self):
+        return self.__pipe
+
+    def attach(self, connection):
+        '''
+        With spawn or forkserver, the module level logger of a worker is a new object,
+        the worker attaches the connection it was given when constructed
+        '''
+        self.__pipe = connection
+
     def add(self, data):
         self.__pipe.send([self.ADD, data])
         
@@ -0,0 +1,121 @@
+import os
+import time
+
+MB = 1024 ** 2
+GB = 1024 ** 3
+FRAME_BYTES = 84 * 84 # one warped gray frame of wrap_deepmind, uint8
+
+def _read_proc_kb(path, keys):
+    values = dict()
+    try:
+        with open(path) as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in keys: values[key] = int(value.split()[0]) * 1024
+    except (FileNotFoundError, ProcessLookupError, PermissionError): # process already exited
+        return None
+    return values
+
+def _read_int(path):
+    try:
+        with open(path) as f:
+            value = f.read().strip()
+        return None if value == 'max' else int(value)
+    except (FileNotFoundError, PermissionError, ValueError):
+        return None
+
+def process_memory(pid):
+    '''
+    rss and its shared part (shared memory and file mappings) in bytes, None if the process is gone
+    '''
+    status = _read_proc_kb('/proc/%d/status'%pid, ('VmRSS', 'RssShmem', 'RssFile'))
+    if status is None: return None
+    return {'rss': status.get('VmRSS', 0), 'shared': status.get('RssShmem', 0) + status.get('RssFile', 0)}
+
+def memory_limit():
+    '''
+    The smaller of the physical memory and the cgroup limit (shared nodes, containers), in bytes
+    '''
+    limit = _read_proc_kb('/proc/meminfo', ('MemTotal',))['MemTotal']
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'): # cgroup v2, v1
+        cgroup_limit = _read_int(path)
+        if cgroup_limit is not None: limit = min(limit, cgroup_limit)
+    return limit
+
+def memory_usage():
+    '''
+    Charged memory of the cgroup if there is one, otherwise used memory of the node, in bytes
+    '''
+    for path in ('/sys/fs/cgroup/memory.current', '/sys/fs/cgroup/memory/memory.usage_in_bytes'):
+        usage = _read_int(path)
+        if usage is not None: return usage
+    meminfo = _read_proc_kb('/proc/meminfo', ('MemTotal', 'MemAvailable'))
+    return meminfo['MemTotal'] - meminfo['MemAvailable']
+
+def shm_usage():
+    try:
+        stat = os.statvfs('/dev/shm')
+    except FileNotFoundError:
+        return 0
+    return (stat.f_blocks - stat.f_bfree) * stat.f_frsize
+
+def size_replay_buffer(replay_buffer_class, **args):
+    '''
+    Replay capacity that fits in --memory_budget after --memory_per_process for every process
+    return (buffer_size, replay_spill_dir, message): the spill dir is kept only if the requested buffer does not fit
+    and the replay buffer can be memory mapped, otherwise the capacity is reduced
+    '''
+    buffer_size, spill_dir = args['buffer_size'], args['replay_spill_dir']
+    if args['memory_budget'] is None:
+        return buffer_size, spill_dir, None
+    num_processes = args['num_actors'] + 3 # learner, evaluator, logger
+    if args['replay_address'] is None or not args['replay_external']: num_processes += 1 # replay buffer or replay server
+    if args['record_dataset'] is not None: num_processes += 1 # dataset recorder
+    free_bytes = args['memory_budget'] * GB - num_processes * args['memory_per_process'] * GB
+    bytes_per_step = replay_buffer_class.bytes_per_step(**args)
+    fit_size = max(int(free_bytes // bytes_per_step), 0)
+    if fit_size >= buffer_size:
+        return buffer_size, None, None
+    if spill_dir is not None and replay_buffer_class.supports_spill:
+        return buffer_size, spill_dir, 'replay buffer of %d steps (%.1f GB) does not fit in the memory budget, memory mapped in %s'%(buffer_size, buffer_size * bytes_per_step / GB, spill_dir)
+    return fit_size, None, 'replay buffer reduced from %d to %d steps to fit in the memory budget of %.1f GB'%(buffer_size, fit_size, args['memory_budget'])
+
+class MemoryMonitor:
+    '''
+    Per process RSS and shared memory of the process graph, usage against the limit
+    '''
+    def __init__(self, **args):
+        self.report_secs = args['memory_report_secs']
+        self.warn_fraction = args['memory_warn_fraction']
+        self.limit = memory_limit()
+        if args['memory_budget'] is not None: self.limit = min(self.limit, args['memory_budget'] * GB)
+        self.processes = [('learner', os.getpid())]
+        self.last_report_time = 0
+
+    def register(self, name, process):
+        self.processes.append((name, process.pid))
+
+    def due(self):
+        return time.time() - self.last_report_time >= self.report_secs
+
+    def report(self):
+        '''
+        return (dict of MB for the logger, warning message or None)
+        '''
+        self.last_report_time = time.time()
+        report, total_rss = dict(), 0
+        for name, pid in self.processes:
+            memory = process_memory(pid)
+            if memory is None: continue
+            report['memory/%s_rss_mb'%name] = memory['rss'] / MB
+            report['memory/%s_shared_mb'%name] = memory['shared'] / MB
+            total_rss += memory['rss']
+        usage = memory_usage()
+        report['memory/total_rss_mb'] = total_rss / MB # shared pages are counted by every process
+        report['memory/shm_mb'] = shm_usage() / MB
+        report['memory/usage_mb'] = usage / MB
+        report['memory/limit_mb'] = self.limit / MB
+        warning = None
+        if usage > self.warn_fraction * self.limit:
+            warning = 'memory usage %.0f MB is above %d%% of the limit %.0f MB'%(usage / MB, 100 * self.warn_fraction, self.limit / MB)
+        return report, warning
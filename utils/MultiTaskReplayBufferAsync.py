@@ -0,0 +1,48 @@
+import numpy as np
+from utils.ReplayBufferAsync import ReplayBuffer, ReplayBufferAsync
+from utils.Wrapper import num_games
+
+class PartitionedReplayBuffer(object):
+    '''
+    One ReplayBuffer per game, so that a game with more (or faster) actors does not crowd out the others
+    A batch is split among the games by sample_weights, a game without transitions yet gets no share
+    '''
+    def __init__(self, num_partitions, size, sample_weights=None):
+        self.partitions = [ReplayBuffer(size // num_partitions) for _ in range(num_partitions)]
+        self.sample_weights = np.ones(num_partitions) if sample_weights is None else np.array(sample_weights, dtype=np.float64)
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions)
+
+    def sample(self, batch_size):
+        '''
+        return obs, action, reward, next_obs, done, game
+        '''
+        weights = self.sample_weights * np.array([len(partition) > 0 for partition in self.partitions])
+        if weights.sum() == 0: raise Exception('Not enough steps in the replay buffer, increase --start_training_steps')
+        batch_sizes = np.random.multinomial(batch_size, weights / weights.sum())
+        batches, games = [], []
+        for game, (partition, size) in enumerate(zip(self.partitions, batch_sizes)):
+            if size == 0: continue
+            batches.append(partition.sample(size))
+            games.append(np.full(size, game, dtype=np.int64))
+        return (*(np.concatenate(field) for field in zip(*batches)), np.concatenate(games))
+
+class MultiTaskReplayBufferAsync(ReplayBufferAsync):
+    '''
+    Multi-task mode (--env_names): actor i plays game i % num_games, its transitions go to the partition of the game
+    sample torch.tensor.cuda() obs, action, reward, next_obs, done and the game of every transition
+    '''
+    def __init__(self, *arg, **args):
+        self.num_games = num_games(**args)
+        self.sample_weights = args['task_sample_weights']
+        if self.sample_weights is not None and len(self.sample_weights) != self.num_games:
+            raise Exception('--task_sample_weights needs one weight per game of --env_names')
+        super().__init__(*arg, **args)
+
+    def _init_storage(self):
+        super()._init_storage()
+        self.replay_buffer = PartitionedReplayBuffer(self.num_games, self.buffer_size, self.sample_weights)
+
+    def _storage(self, stream):
+        return self.replay_buffer.partitions[stream % self.num_games]
@@ -1,6 +1,8 @@
+import math
+import numpy as np
 import torch
 import torch.nn as nn
-import torch.autograd as autograd 
+import torch.autograd as autograd
 import torch.nn.functional as F
 
 def layer_init(layer, w_scale=1.0):
@@ -9,9 +11,133 @@ def layer_init(layer, w_scale=1.0):
     nn.init.constant_(layer.bias.data, 0)
     return layer
 
-class LinearQNetwork(nn.Module):
-    def __init__(self, input_shape, num_actions):
+class NoisyLinear(nn.Module):
+    '''Factorized Gaussian NoisyNet layer (Fortunato et al. 2017)
+    A fresh noise sample is drawn in every forward pass in training mode, no noise buffers are kept,
+    so a network shared between processes can be used by all of them without resetting noise.
+    In eval mode only the mean weights are used.
+    '''
+    def __init__(self, in_features, out_features, sigma_0=0.5):
+        super(NoisyLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.weight_mu = nn.Parameter(torch.empty(out_features, in_features))
+        self.weight_sigma = nn.Parameter(torch.empty(out_features, in_features))
+        self.bias_mu = nn.Parameter(torch.empty(out_features))
+        self.bias_sigma = nn.Parameter(torch.empty(out_features))
+        bound = 1 / math.sqrt(in_features)
+        nn.init.uniform_(self.weight_mu, -bound, bound)
+        nn.init.uniform_(self.bias_mu, -bound, bound)
+        nn.init.constant_(self.weight_sigma, sigma_0 * bound)
+        nn.init.constant_(self.bias_sigma, sigma_0 * bound)
+
+    @staticmethod
+    def _scale_noise(size, device):
+        x = torch.randn(size, device=device)
+        return x.sign() * x.abs().sqrt()
+
+    def forward(self, x):
+        if not self.training:
+            return F.linear(x, self.weight_mu, self.bias_mu)
+        eps_in = self._scale_noise(self.in_features, x.device)
+        eps_out = self._scale_noise(self.out_features, x.device)
+        weight = self.weight_mu + self.weight_sigma * (eps_out.unsqueeze(1) * eps_in.unsqueeze(0))
+        bias = self.bias_mu + self.bias_sigma * eps_out
+        return F.linear(x, weight, bias)
+
+class QHead(nn.Module):
+    '''Dueling and/or noisy head
+    Output is flattened to (batch, num_actions * num_outputs) as the plain fc head
+    '''
+    def __init__(self, in_features, num_actions, num_outputs=1, dueling=False, noisy=False, hidden_size=512):
+        super(QHead, self).__init__()
+        self.num_actions = num_actions
+        self.num_outputs = num_outputs
+        self.dueling = dueling
+        linear = NoisyLinear if noisy else lambda in_size, out_size: layer_init(nn.Linear(in_size, out_size))
+        self.advantage = nn.Sequential(
+            linear(in_features, hidden_size),
+            nn.ReLU(),
+            linear(hidden_size, num_actions * num_outputs)
+        )
+        if dueling:
+            self.value = nn.Sequential(
+                linear(in_features, hidden_size),
+                nn.ReLU(),
+                linear(hidden_size, num_outputs)
+            )
+
+    def forward(self, x):
+        x_adv = self.advantage(x).view(-1, self.num_actions, self.num_outputs)
+        if self.dueling:
+            x_val = self.value(x).view(-1, 1, self.num_outputs)
+            x_adv = x_val + x_adv - x_adv.mean(1, keepdim=True)
+        return x_adv.reshape(x.size(0), -1)
+
+def make_head(in_features, num_actions, num_outputs=1, dueling=False, noisy=False):
+    if not dueling and not noisy: # keep the original layout, so that the saved models can still be loaded
+        return nn.Sequential(
+            layer_init(nn.Linear(in_features, 512)),
+            nn.ReLU(),
+            layer_init(nn.Linear(512, num_actions * num_outputs))
+        )
+    return QHead(in_features, num_actions, num_outputs, dueling=dueling, noisy=noisy)
+
+class QNetworkBase(nn.Module):
+    '''Shared action selection
+    Subclasses implement forward(), q_values() is overridden if forward() does not return Q values
+    '''
+    noisy = False
+    recurrent = False
+    game = 0 # multi-task networks act for this game
+
+    @property
+    def device(self):
+        return next(self.parameters()).device
+
+    def _as_tensor(self, states):
+        if not torch.is_tensor(states):
+            states = np.stack([np.asarray(s) for s in states]) if isinstance(states, (list, tuple)) else np.asarray(states)
+        states = torch.as_tensor(states, device=self.device)
+        return states if states.dtype == torch.uint8 else states.float()
+
+    def q_values(self, x):
+        return self.forward(x)
+
+    def act(self, state, eps=0.):
+        '''
+        Epsilon greedy action of one state, drawn with the numpy random state of the process
+        NoisyNet explores by itself, eps is ignored. The forward pass is skipped on a random action,
+        except for recurrent networks: their state has to see every frame, even if the action is random
+        '''
+        is_random = not self.noisy and np.random.random() < eps
+        if is_random and not self.recurrent: return np.random.randint(self.num_actions)
+        with torch.no_grad():
+            q_value = self.q_values(self._as_tensor(state).unsqueeze(0))
+            action = torch.argmax(q_value, dim=-1).item()
+        return np.random.randint(self.num_actions) if is_random else action
+
+    def act_batch(self, states, eps=0.):
+        '''
+        Epsilon greedy actions of a batch of states, all on device
+        eps is a float or a tensor/array with one epsilon per state
+        return a long tensor on device
+        '''
+        with torch.no_grad():
+            q_value = self.q_values(self._as_tensor(states))
+            greedy_actions = torch.argmax(q_value, dim=-1)
+            if self.noisy: return greedy_actions
+            batch_size = greedy_actions.shape[0]
+            eps = torch.as_tensor(eps, dtype=torch.float32, device=greedy_actions.device).expand(batch_size)
+            is_random = torch.rand(batch_size, device=greedy_actions.device) < eps
+            random_actions = torch.randint(self.num_actions, (batch_size,), device=greedy_actions.device)
+            return torch.where(is_random, random_actions, greedy_actions)
+
+class LinearQNetwork(QNetworkBase):
+    def __init__(self, input_shape, num_actions, **args):
         super(LinearQNetwork, self).__init__()
+        if args.get('dueling', False) or args.get('noisy', False): raise Exception('LinearQNetwork does not support --dueling or --noisy')
+        self.num_actions = num_actions
         self.layers = nn.Sequential(
             layer_init(nn.Linear(input_shape[0], 128)),
             nn.ReLU(),
@@ -19,21 +145,16 @@ class LinearQNetwork(nn.Module):
             nn.ReLU(),
             layer_init(nn.Linear(128, num_actions))
         )
-        
+
     def forward(self, x):
         return self.layers(x)
-    
-    def act(self, state):
-        with torch.no_grad():
-            state   = torch.FloatTensor(state).unsqueeze(0).cuda()
-            q_value = self.forward(state)
-            action  = q_value.max(1)[1].data[0]
-        return action.cpu().numpy()
 
-class CnnQNetwork(nn.Module):
-    def __init__(self, input_shape, num_actions):
+class CnnQNetwork(QNetworkBase):
+    def __init__(self, input_shape, num_actions, **args):
         super(CnnQNetwork, self).__init__()
+        self.num_actions = num_actions
         self.input_shape = input_shape
+        self.noisy = args.get('noisy', False)
         self.features = nn.Sequential(
             layer_init(nn.Conv2d(input_shape[0], 32, kernel_size=8, stride=4)),
             nn.ReLU(),
@@ -42,13 +163,9 @@ class CnnQNetwork(nn.Module):
             layer_init(nn.Conv2d(64, 64, kernel_size=3, stride=1)),
             nn.ReLU()
         )
-        
-        self.fc = nn.Sequential(
-            layer_init(nn.Linear(self.feature_size(), 512)),
-            nn.ReLU(),
-            layer_init(nn.Linear(512, num_actions))
-        )
-        
+
+        self.fc = make_head(self.feature_size(), num_actions, dueling=args.get('dueling', False), noisy=self.noisy)
+
     def forward(self, x):
         x = self.features(x / 255.0)
         x = x.view(x.size(0), -1)
@@ -58,18 +175,12 @@ class CnnQNetwork(nn.Module):
     def feature_size(self):
         return self.features(autograd.Variable(torch.zeros(1, *self.input_shape))).view(1, -1).size(1)
 
-    def act(self, state):
-        with torch.no_grad():
-            state   = torch.FloatTensor(state).unsqueeze(0).cuda()
-            q_value = self.forward(state)
-            action  = q_value.max(1)[1].data[0]
-        return action.cpu().numpy()
-
-class CatLinearQNetwork(nn.Module):
+class CatLinearQNetwork(QNetworkBase):
     '''Categorical Linear Q network
     '''
     def __init__(self, input_shape, num_actions, **args):
         super(CatLinearQNetwork, self).__init__()
+        if args.get('dueling', False) or args.get('noisy', False): raise Exception('CatLinearQNetwork does not support --dueling or --noisy')
         self.num_actions  = num_actions
         self.num_atoms    = args['num_atoms']
         self.Vmin         = args['v_min']
@@ -83,21 +194,19 @@ class CatLinearQNetwork(nn.Module):
             nn.ReLU(),
             layer_init(nn.Linear(512, num_actions * self.num_atoms))
         )
+        self.register_buffer('atoms', torch.linspace(self.Vmin, self.Vmax, self.num_atoms), persistent=False) # follows .cuda(), not in the saved models
 
     def forward(self, x):
         x = self.layers(x)
-        x = F.softmax(x.view(-1, self.num_atoms)).view(-1, self.num_actions, self.num_atoms)
+        x = F.softmax(x.view(-1, self.num_atoms), dim=-1).view(-1, self.num_actions, self.num_atoms)
         return x
-    
-    def act(self, state):
-        with torch.no_grad():
-            state = torch.FloatTensor(state).unsqueeze(0).cuda()
-            dist = self.forward(state).data.cpu()
-            dist = dist * torch.linspace(self.Vmin, self.Vmax, self.num_atoms)
-            action = dist.sum(2).max(1)[1].numpy()[0]
-        return action
 
-class CatCnnQNetwork(nn.Module):
+    def q_values(self, x):
+        self.action_prob = self.forward(x)
+        self.action_Q = (self.action_prob * self.atoms).sum(-1)
+        return self.action_Q
+
+class CatCnnQNetwork(QNetworkBase):
     '''Categorical Linear Q network
     '''
     def __init__(self, input_shape, num_actions, **args):
@@ -107,6 +216,7 @@ class CatCnnQNetwork(nn.Module):
         self.Vmin         = args['v_min']
         self.Vmax         = args['v_max']
         self.input_shape = input_shape
+        self.noisy = args.get('noisy', False)
 
         self.features = nn.Sequential(
             layer_init(nn.Conv2d(input_shape[0], 32, kernel_size=8, stride=4)),
@@ -116,13 +226,9 @@ class CatCnnQNetwork(nn.Module):
             layer_init(nn.Conv2d(64, 64, kernel_size=3, stride=1)),
             nn.ReLU()
         )
-        self.fc = nn.Sequential(
-            layer_init(nn.Linear(self.feature_size(), 512)),
-            nn.ReLU(),
-            layer_init(nn.Linear(512, num_actions * self.num_atoms))
-        )
-        
-        self.atoms = torch.linspace(self.Vmin, self.Vmax, self.num_atoms, device=torch.device(0))
+        self.fc = make_head(self.feature_size(), num_actions, self.num_atoms, dueling=args.get('dueling', False), noisy=self.noisy)
+
+        self.register_buffer('atoms', torch.linspace(self.Vmin, self.Vmax, self.num_atoms), persistent=False) # follows .cuda(), not in the saved models
 
     def forward(self, x):
         x = self.features(x / 255.0)
@@ -141,10 +247,101 @@ class CatCnnQNetwork(nn.Module):
     def feature_size(self):
         return self.features(autograd.Variable(torch.zeros(1, *self.input_shape))).view(1, -1).size(1)
 
-    def act(self, state):
-        with torch.no_grad():
-            state = torch.as_tensor(state, device=torch.device(0)).unsqueeze(0)
-            self.action_prob = self.forward(state)
-            self.action_Q = (self.action_prob * self.atoms).sum(-1)
-            action = torch.argmax(self.action_Q, dim=-1).item()
-        return action
\ No newline at end of file
+    def q_values(self, x):
+        self.action_prob = self.forward(x)
+        self.action_Q = (self.action_prob * self.atoms).sum(-1)
+        return self.action_Q
+
+class MultiTaskCatCnnQNetwork(CatCnnQNetwork):
+    '''Categorical CNN Q network shared by the games of --env_names, one head output per game
+    The trunk and the hidden layer of the head are shared, the last layer gives the atoms of every (action, game),
+    and the slice of the game of every state is gathered. forward() without game uses the process local *game*
+    (set by the actor or evaluator), the learner gives the game of every transition of a mixed batch.
+    '''
+    def __init__(self, input_shape, num_actions, **args):
+        super(MultiTaskCatCnnQNetwork, self).__init__(input_shape, num_actions, **args)
+        self.num_games = len(args['env_names'])
+        # num_outputs per action is num_games * num_atoms, so that the dueling mean over actions stays within a game
+        self.fc = make_head(self.feature_size(), num_actions, self.num_games * self.num_atoms, dueling=args.get('dueling', False), noisy=self.noisy)
+
+    def _logits(self, x, game):
+        x = self.features(x / 255.0)
+        x = x.view(x.size(0), -1)
+        x = self.fc(x).view(-1, self.num_actions, self.num_games, self.num_atoms)
+        if game is None: return x[:, :, self.game]
+        return x[torch.arange(x.size(0), device=x.device), :, game]
+
+    def forward(self, x, game=None):
+        return F.softmax(self._logits(x, game), dim=-1)
+
+    def forward_log(self, x, game=None):
+        return F.log_softmax(self._logits(x, game), dim=-1)
+
+class RecurrentCnnQNetwork(QNetworkBase):
+    '''Recurrent Q network (R2D2), one frame per step, the history is kept by an LSTM instead of frame stacking
+    forward() is a single step from the process local state *hidden* (used to act),
+    forward_sequence() unrolls a batch of sequences from given states (used to train)
+    '''
+    recurrent = True
+
+    def __init__(self, input_shape, num_actions, **args):
+        super(RecurrentCnnQNetwork, self).__init__()
+        self.num_actions = num_actions
+        self.input_shape = input_shape
+        self.hidden_size = args['recurrent_hidden_size']
+        self.noisy = args.get('noisy', False)
+        self.features = nn.Sequential(
+            layer_init(nn.Conv2d(input_shape[0], 32, kernel_size=8, stride=4)),
+            nn.ReLU(),
+            layer_init(nn.Conv2d(32, 64, kernel_size=4, stride=2)),
+            nn.ReLU(),
+            layer_init(nn.Conv2d(64, 64, kernel_size=3, stride=1)),
+            nn.ReLU()
+        )
+        self.lstm = nn.LSTMCell(self.feature_size(), self.hidden_size)
+        self.fc = make_head(self.hidden_size, num_actions, dueling=args.get('dueling', False), noisy=self.noisy)
+        self.hidden = None
+
+    def feature_size(self):
+        return self.features(autograd.Variable(torch.zeros(1, *self.input_shape))).view(1, -1).size(1)
+
+    def initial_state(self, batch_size):
+        zeros = torch.zeros(batch_size, self.hidden_size, device=self.device)
+        return zeros, zeros.clone()
+
+    def forward_sequence(self, x, state, first=None):
+        '''
+        x       (B, T, C, H, W)
+        state   (h, c), each (B, hidden_size)
+        first   (B, T) bool, the state is reset before the steps where first is True
+        return Q (B, T, num_actions) and the final state
+        '''
+        batch_size, seq_len = x.shape[:2]
+        features = self.features(x.reshape(batch_size * seq_len, *x.shape[2:]) / 255.0).view(batch_size, seq_len, -1)
+        h, c = state
+        outputs = []
+        for t in range(seq_len):
+            if first is not None:
+                keep = (~first[:, t]).float().unsqueeze(-1)
+                h, c = h * keep, c * keep
+            h, c = self.lstm(features[:, t], (h, c))
+            outputs.append(h)
+        q_value = self.fc(torch.stack(outputs, 1).view(batch_size * seq_len, -1)).view(batch_size, seq_len, -1)
+        return q_value, (h, c)
+
+    def forward(self, x):
+        if self.hidden is None or self.hidden[0].shape[0] != x.shape[0]:
+            self.hidden = self.initial_state(x.shape[0])
+        q_value, self.hidden = self.forward_sequence(x.unsqueeze(1), self.hidden)
+        return q_value[:, 0]
+
+    def reset_hidden(self):
+        self.hidden = None
+
+    def recurrent_state(self):
+        '''
+        (h, c) of the first element of the acting batch as one numpy array, zeros after a reset
+        '''
+        if self.hidden is None:
+            return np.zeros(2 * self.hidden_size, dtype=np.float32)
+        return torch.cat([self.hidden[0][0], self.hidden[1][0]]).cpu().numpy()
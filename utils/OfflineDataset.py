@@ -0,0 +1,153 @@
+import os
+import json
+import glob
+import queue
+import threading
+import numpy as np
+import torch.multiprocessing as mp
+from utils.ReplayBufferAsync import ReplayBufferAsync
+
+'''
+Dataset layout
+    <dataset_path>/meta.json            env_name, stack_frames, obs shape
+    <dataset_path>/chunk_000000.npz     compressed arrays of one chunk of the actor stream
+        action  int64   -1 for a reset frame
+        obs     uint8   the newest frame only, the frames are stacked again when read (as in ReplayBufferAsync)
+        reward  float32
+        done    bool
+Every chunk holds the steps of one actor and starts with a reset frame, so that chunks can be read in any order
+'''
+
+class DatasetRecorderAsync(mp.Process):
+    '''
+    Record the actor stream to a chunked, compressed dataset
+    Compression and disk writes are done in this process, the learner only sends batches of steps
+    '''
+    ADD = 0
+    CLOSE = 1
+
+    def __init__(self, **args):
+        mp.Process.__init__(self)
+        self.dataset_path = args['record_dataset']
+        self.chunk_steps = args['dataset_chunk_steps']
+        self.send_steps = 256
+        self.meta = {'env_name': args['env_name'], 'env_names': args['env_names'], 'stack_frames': args['stack_frames'], 'seed': args['seed']}
+        self.__pipe, self.__worker_pipe = mp.Pipe()
+        self.send_cache = []
+        self.start()
+
+    def _flush_chunk(self, stream):
+        chunk = self.chunks.pop(stream, None)
+        if chunk is None: return
+        np.savez_compressed(os.path.join(self.dataset_path, 'chunk_%06d.npz'%self.chunk_idx),
+            action = np.array(chunk['action'], dtype=np.int64),
+            obs = np.stack(chunk['obs']),
+            reward = np.array(chunk['reward'], dtype=np.float32),
+            done = np.array(chunk['done'], dtype=bool))
+        self.chunk_idx += 1
+
+    def _add(self, action, obs, reward, done, stream=0):
+        if action is None:
+            if stream in self.chunks and len(self.chunks[stream]['action']) >= self.chunk_steps: # only cut chunks at a reset
+                self._flush_chunk(stream)
+            if stream not in self.chunks:
+                self.chunks[stream] = {'action': [], 'obs': [], 'reward': [], 'done': []}
+            action, reward, done = -1, 0., False
+        elif stream not in self.chunks: # the stream does not start with a reset, cannot stack the frames
+            return
+        chunk = self.chunks[stream]
+        chunk['action'].append(action)
+        chunk['obs'].append(obs)
+        chunk['reward'].append(reward)
+        chunk['done'].append(done)
+
+    def run(self):
+        os.makedirs(self.dataset_path, exist_ok=True)
+        self.chunk_idx = len(glob.glob(os.path.join(self.dataset_path, 'chunk_*.npz'))) # append to an existing dataset
+        self.chunks = dict() # one open chunk per stream
+        while True:
+            cmd, data = self.__worker_pipe.recv()
+            if cmd == self.ADD:
+                for transition in data:
+                    if 'obs_shape' not in self.meta:
+                        self.meta['obs_shape'] = list(transition[1].shape)
+                        with open(os.path.join(self.dataset_path, 'meta.json'), 'w') as f:
+                            json.dump(self.meta, f)
+                    self._add(*transition)
+
+            elif cmd == self.CLOSE:
+                for stream in list(self.chunks):
+                    self._flush_chunk(stream)
+                self.__worker_pipe.close()
+                return
+            else:
+                raise NotImplementedError
+
+    def add(self, action, obs, reward, done, stream=0):
+        '''
+        if action is none, it is the reset frame
+        '''
+        self.send_cache.append((action, obs, reward, done, stream))
+        if len(self.send_cache) >= self.send_steps:
+            self.__pipe.send([self.ADD, self.send_cache])
+            self.send_cache = []
+
+    def close(self):
+        self.__pipe.send([self.ADD, self.send_cache])
+        self.send_cache = []
+        self.__pipe.send([self.CLOSE, None])
+        self.__pipe.close()
+
+class OfflineReplayBufferAsync(ReplayBufferAsync):
+    '''
+    Replay buffer filled from a recorded dataset instead of an actor
+    Chunks are read in a shuffled order (reshuffled every epoch) and decompressed by a thread,
+    *dataset_prefetch_chunks* chunks ahead. The buffer is a sliding window over the stream:
+    it is filled with *start_training_steps* steps, then *offline_ingest_steps* steps are added before every sample
+    '''
+    def __init__(self, *arg, **args):
+        self.dataset_path = args['offline_dataset']
+        self.prefetch_chunks = args['dataset_prefetch_chunks']
+        self.prefill_steps = args['start_training_steps']
+        self.ingest_steps = args['offline_ingest_steps']
+        self.chunk_files = sorted(glob.glob(os.path.join(self.dataset_path, 'chunk_*.npz')))
+        if len(self.chunk_files) == 0: raise Exception("No dataset chunk found in %s"%self.dataset_path)
+        with open(os.path.join(self.dataset_path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        for key in ('env_name', 'env_names'):
+            if self.meta.get(key) != args[key]:
+                raise Exception("Dataset %s was recorded with --%s %s, not %s"%(self.dataset_path, key, self.meta.get(key), args[key]))
+        super().__init__(*arg, **args)
+
+    def check_observation_shape(self, observation_shape):
+        # the dataset holds the newest frame of every observation
+        if tuple(self.meta['obs_shape']) != (1, *observation_shape[1:]):
+            raise Exception("Dataset %s has frames of shape %s, the env gives observations of shape %s"%(self.dataset_path, tuple(self.meta['obs_shape']), tuple(observation_shape)))
+
+    def _load_chunks(self):
+        rng = np.random.RandomState(self.seed)
+        while True:
+            for chunk_idx in rng.permutation(len(self.chunk_files)):
+                with np.load(self.chunk_files[chunk_idx]) as chunk:
+                    chunk = {key: chunk[key] for key in chunk.files} # decompress here, not in the sampling loop
+                self.chunk_queue.put(chunk)
+
+    def _steps(self):
+        while True:
+            chunk = self.chunk_queue.get()
+            for action, obs, reward, done in zip(chunk['action'], chunk['obs'], chunk['reward'], chunk['done']):
+                yield (None if action < 0 else action), obs, reward, done
+
+    def _ingest(self, steps_no):
+        for _ in range(steps_no):
+            self._add(*next(self.step_iterator))
+
+    def _init_storage(self):
+        super()._init_storage()
+        self.chunk_queue = queue.Queue(maxsize=self.prefetch_chunks)
+        threading.Thread(target=self._load_chunks, daemon=True).start()
+        self.step_iterator = self._steps()
+        self._ingest(self.prefill_steps)
+
+    def _before_sample(self):
+        self._ingest(self.ingest_steps)
@@ -0,0 +1,108 @@
+import time
+import torch
+import torch.multiprocessing as mp
+
+class FlatParameters:
+    '''
+    Pack all parameters (and floating point buffers) of a network into one contiguous tensor.
+    The parameters of the network become views of *flat*, so copying a whole network is one memcpy.
+    The Parameter objects are kept, thus an optimizer can be built before or after packing.
+    '''
+    def __init__(self, network):
+        tensors = list(network.parameters()) + [b for b in network.buffers() if b.is_floating_point()]
+        self.flat = torch.cat([t.detach().reshape(-1) for t in tensors])
+        offset = 0
+        for t in tensors:
+            numel = t.numel()
+            t.data = self.flat[offset:offset+numel].view_as(t)
+            offset += numel
+
+    def copy_(self, other):
+        with torch.no_grad():
+            self.flat.copy_(other.flat)
+
+    def soft_update_(self, other, tau):
+        # Polyak averaging: self = (1 - tau) * self + tau * other
+        with torch.no_grad():
+            self.flat.lerp_(other.flat, tau)
+
+class DoubleBufferHandoff:
+    '''
+    Non-blocking weight handoff from one producer process to one consumer process.
+    The producer writes into the back buffer and flips the front index,
+    the consumer copies the front buffer out.
+    The lock only guards the flip and the copy out, so no side waits longer than one memcpy.
+    Must be constructed before the consumer process starts, the buffer is sent afterwards by *allocate*.
+    '''
+    def __init__(self):
+        self.lock = mp.Lock()
+        self.front = mp.Value('i', 0, lock=False)
+        self.version = mp.Value('l', -1, lock=False)
+        self.buffer = None
+
+    def allocate(self, flat_params):
+        self.buffer = torch.zeros((2, *flat_params.flat.shape), dtype=flat_params.flat.dtype, device=flat_params.flat.device)
+        return self.buffer
+
+    def attach(self, buffer):
+        self.buffer = buffer
+
+    def publish(self, flat_params, version):
+        back = 1 - self.front.value
+        with torch.no_grad():
+            self.buffer[back].copy_(flat_params.flat)
+        if self.buffer.is_cuda: torch.cuda.synchronize(self.buffer.device)
+        with self.lock:
+            self.front.value = back
+            self.version.value = version
+
+    def pull(self, flat_params):
+        with self.lock:
+            with torch.no_grad():
+                flat_params.flat.copy_(self.buffer[self.front.value])
+            if self.buffer.is_cuda: torch.cuda.synchronize(self.buffer.device)
+            return self.version.value
+
+class VersionedSnapshots:
+    '''
+    Ring of *num_slots* weight snapshots, the snapshot of version v is in slot v % num_slots
+    Used by the deterministic mode: a reader asks for an exact version, which is a function of its logical step,
+    not for the latest one. The writer must never be more than num_slots - 1 versions ahead of any reader.
+    The writer does not wait for its copy: it records an interprocess CUDA event per slot, the reader's stream waits on it.
+    Must be constructed before the reader processes start, the buffer and events are sent afterwards (*shared*, *attach*).
+    '''
+    def __init__(self, num_slots):
+        self.num_slots = num_slots
+        self.versions = mp.Array('q', [-2**62] * num_slots, lock=False)
+        self.buffer, self.events = None, None
+
+    def allocate(self, flat_params):
+        self.buffer = torch.zeros((self.num_slots, *flat_params.flat.shape), dtype=flat_params.flat.dtype, device=flat_params.flat.device)
+        if self.buffer.is_cuda:
+            with torch.cuda.device(self.buffer.device):
+                self.events = [torch.cuda.Event(interprocess=True) for _ in range(self.num_slots)]
+        return self.buffer
+
+    def shared(self):
+        return [self.buffer, self.events]
+
+    def attach(self, buffer, events):
+        self.buffer, self.events = buffer, events
+
+    def publish(self, flat_params, version):
+        slot = version % self.num_slots
+        with torch.no_grad():
+            self.buffer[slot].copy_(flat_params.flat)
+        if self.events is not None: self.events[slot].record(torch.cuda.current_stream(self.buffer.device))
+        self.versions[slot] = version # after the record, so a reader that sees the version waits on this copy
+
+    def read(self, flat_params, version):
+        slot = version % self.num_slots
+        while self.versions[slot] != version: # normally already published, the writer publishes before it requests the next step
+            if self.versions[slot] > version: raise Exception('Weights version %d was overwritten, the reader is too far behind'%version)
+            time.sleep(1e-4)
+        if self.events is not None: torch.cuda.current_stream(self.buffer.device).wait_event(self.events[slot])
+        with torch.no_grad():
+            flat_params.flat.copy_(self.buffer[slot])
+        # the slot is reused once the writer moves on, which it only does after this reader is done
+        if self.buffer.is_cuda: torch.cuda.current_stream(self.buffer.device).synchronize()
@@ -0,0 +1,163 @@
+import os
+import sys
+import json
+import glob
+import time
+import signal
+import contextlib
+import torch
+
+'''
+Profile layout
+    <profile_dir>/<process>_<pid>_<window>.spans.json   wall clock spans of one capture window
+    <profile_dir>/<process>_<pid>_<window>.torch.json   torch.profiler chrome trace of the same window
+    <profile_dir>/merged_trace.json                     all windows of all processes on one timeline, see merge_traces
+A capture window is started by SIGUSR1: `kill -USR1 <pid of main.py>` captures *profile_window* seconds in every process
+'''
+
+class _Span:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler.depth += 1
+        self.start = time.time()
+
+    def __exit__(self, *exc):
+        end = time.time()
+        self.profiler.spans.append([self.name, self.start * 1e6, (end - self.start) * 1e6])
+        self.profiler.depth -= 1
+        if self.profiler.depth == 0 and end >= self.profiler.window_end: self.profiler._stop() # never cut an enclosing span
+
+class Profiler:
+    '''
+    Per process capture windows of wall clock spans and torch.profiler
+    Every process calls init with its name (workers at the top of run), the main process registers the workers
+    and forwards the signal to them. The signal only sets a flag, the window starts at the next span,
+    so spans are never cut and torch.profiler is not started inside the handler
+    '''
+    _null_span = contextlib.nullcontext()
+
+    def __init__(self):
+        self.enabled = False
+        self.requested = False
+        self.capturing = False
+        self.window_end = float('inf')
+        self.processes = []
+
+    @staticmethod
+    def options(**args):
+        # what a worker needs to init its profiler, stored when the worker is constructed
+        return {'profile': args['profile'], 'profile_dir': args['profile_dir'], 'profile_window': args['profile_window']}
+
+    def init(self, name, **args):
+        self.enabled = args['profile']
+        if not self.enabled: return
+        self.name = name
+        self.profile_dir = args['profile_dir']
+        self.profile_window = args['profile_window']
+        self.window_idx = 0
+        self.processes = [] # a forked worker must not forward to the workers of its parent
+        os.makedirs(self.profile_dir, exist_ok=True)
+        signal.signal(signal.SIGUSR1, self._on_signal)
+
+    def register(self, process):
+        '''
+        Forward the capture signal to process, after it is started
+        '''
+        if self.enabled: self.processes.append(process)
+
+    def _on_signal(self, signum, frame):
+        self.requested = True
+        for process in self.processes:
+            if process.is_alive(): os.kill(process.pid, signal.SIGUSR1)
+
+    def span(self, name):
+        '''
+        with profiler.span('replay.sample'): ...
+        '''
+        if self.requested and not self.capturing: self._start()
+        if not self.capturing: return self._null_span
+        return _Span(self, name)
+
+    def _start(self):
+        self.requested = False
+        self.capturing = True
+        self.spans = []
+        self.depth = 0
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available(): activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.torch_profiler = torch.profiler.profile(activities=activities)
+        self.torch_profiler.start()
+        self.window_start = time.time()
+        self.window_end = self.window_start + self.profile_window
+
+    def _stop(self):
+        self.torch_profiler.stop()
+        path = os.path.join(self.profile_dir, '%s_%d_%d'%(self.name, os.getpid(), self.window_idx))
+        self.torch_profiler.export_chrome_trace(path + '.torch.json')
+        with open(path + '.spans.json', 'w') as f:
+            json.dump({'process': self.name, 'pid': os.getpid(), 'window_start': self.window_start * 1e6, 'spans': self.spans}, f)
+        self.window_idx += 1
+        self.capturing = False
+        self.window_end = float('inf')
+        self.torch_profiler = None
+
+def _torch_offset(trace, window_start):
+    '''
+    Offset in us from the timestamps of a torch chrome trace to the wall clock
+    Recent versions give the base time of the relative timestamps, older ones write wall clock timestamps.
+    Anything else is aligned on the start of the window
+    '''
+    if 'baseTimeNanoseconds' in trace: return trace['baseTimeNanoseconds'] / 1e3
+    timestamps = [event['ts'] for event in trace.get('traceEvents', []) if 'ts' in event]
+    if len(timestamps) == 0 or abs(min(timestamps) - window_start) < 3600 * 1e6: return 0.
+    return window_start - min(timestamps)
+
+def merge_traces(profile_dir, output_path=None):
+    '''
+    Merge the spans and torch traces of every process and window into one chrome trace (chrome://tracing, perfetto)
+    Every process gets one track group, torch gpu events (whose pid is the device) are moved into the group of their process
+    '''
+    output_path = os.path.join(profile_dir, 'merged_trace.json') if output_path is None else output_path
+    events, pid_map = [], dict()
+    def merged_pid(name, pid, group):
+        if (name, pid, group) not in pid_map:
+            pid_map[(name, pid, group)] = len(pid_map)
+            label = '%s (%d)'%(name, pid) if group is None else '%s (%d) %s'%(name, pid, group)
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': pid_map[(name, pid, group)], 'args': {'name': label}})
+            events.append({'name': 'process_sort_index', 'ph': 'M', 'pid': pid_map[(name, pid, group)], 'args': {'sort_index': len(pid_map)}})
+        return pid_map[(name, pid, group)]
+
+    for spans_path in sorted(glob.glob(os.path.join(profile_dir, '*.spans.json'))):
+        with open(spans_path) as f:
+            spans = json.load(f)
+        name, pid = spans['process'], spans['pid']
+        span_pid = merged_pid(name, pid, None)
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': span_pid, 'tid': 0, 'args': {'name': 'spans'}})
+        for span_name, start, duration in spans['spans']:
+            events.append({'name': span_name, 'cat': 'span', 'ph': 'X', 'ts': start, 'dur': duration, 'pid': span_pid, 'tid': 0})
+
+        torch_path = spans_path[:-len('.spans.json')] + '.torch.json'
+        if not os.path.exists(torch_path): continue
+        with open(torch_path) as f:
+            trace = json.load(f)
+        offset = _torch_offset(trace, spans['window_start'])
+        for event in trace.get('traceEvents', []):
+            if 'pid' not in event: continue
+            if event.get('ph') == 'M' and event.get('name') in ('process_name', 'process_labels', 'process_sort_index'): continue
+            event = dict(event)
+            event['pid'] = merged_pid(name, pid, None if event['pid'] == pid else 'device %s'%event['pid'])
+            if 'ts' in event: event['ts'] = float(event['ts']) + offset
+            events.append(event)
+
+    with open(output_path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    return output_path
+
+profiler = Profiler()
+
+if __name__ == '__main__':
+    # python -m utils.Profiler <profile_dir> [output_path]
+    print(merge_traces(*sys.argv[1:3]))
@@ -1,12 +1,47 @@
-from cv2 import data
 import torch
 import numpy as np
 import torch.multiprocessing as mp
 from collections import deque
 import random
+import time
 from utils.Wrapper import LazyFrames
+from utils.StartupTimer import startup_timer
+from utils.Profiler import profiler, Profiler
+from utils.MemoryMonitor import FRAME_BYTES
 
-from baselines.deepq.replay_buffer import ReplayBuffer
+# Same as baselines.deepq.replay_buffer.ReplayBuffer
+# importing baselines.deepq also imports tensorflow, which takes seconds in every replay process
+class ReplayBuffer(object):
+    def __init__(self, size):
+        self._storage = []
+        self._maxsize = size
+        self._next_idx = 0
+
+    def __len__(self):
+        return len(self._storage)
+
+    def add(self, obs_t, action, reward, obs_tp1, done):
+        data = (obs_t, action, reward, obs_tp1, done)
+        if self._next_idx >= len(self._storage):
+            self._storage.append(data)
+        else:
+            self._storage[self._next_idx] = data
+        self._next_idx = (self._next_idx + 1) % self._maxsize
+
+    def _encode_sample(self, idxes):
+        obses_t, actions, rewards, obses_tp1, dones = [], [], [], [], []
+        for i in idxes:
+            obs_t, action, reward, obs_tp1, done = self._storage[i]
+            obses_t.append(np.array(obs_t, copy=False))
+            actions.append(np.array(action, copy=False))
+            rewards.append(reward)
+            obses_tp1.append(np.array(obs_tp1, copy=False))
+            dones.append(done)
+        return np.array(obses_t), np.array(actions), np.array(rewards), np.array(obses_tp1), np.array(dones)
+
+    def sample(self, batch_size):
+        idxes = [random.randint(0, len(self._storage) - 1) for _ in range(batch_size)]
+        return self._encode_sample(idxes)
 
 class ReplayBufferAsync(mp.Process):
     '''
@@ -16,6 +51,12 @@ class ReplayBufferAsync(mp.Process):
     ADD = 0
     SAMPLE = 1
     CLOSE = 2
+    supports_spill = False # the transitions are python objects, they cannot be memory mapped
+
+    @staticmethod
+    def bytes_per_step(**args):
+        # one new frame per step, plus the LazyFrames, tuple and scalar objects of the transition
+        return FRAME_BYTES + 512
 
     def __init__(self, *arg, **args):
         mp.Process.__init__(self)
@@ -28,6 +69,8 @@ class ReplayBufferAsync(mp.Process):
         self.is_init_cache = False
         self.out_pointer = 1 # output pointer 0 when initialize, 1 when first output
         self.in_pointer = 0 # update pointer 0 when first update
+        self.ready_time = startup_timer.register('replay_buffer')
+        self.profile_options = Profiler.options(**args)
         self.start()
 
     def init_seed(self):
@@ -36,54 +79,63 @@ class ReplayBufferAsync(mp.Process):
         random.seed(self.seed)
         np.random.seed(self.seed)
 
+    def _init_storage(self):
+        self.replay_buffer = ReplayBuffer(self.buffer_size)
+        self.frames, self.last_frames = dict(), dict()
+
+    def _add(self, action, obs, reward, done, stream=0):
+        # frames are stacked per stream (actor), so that the transitions of different actors do not mix
+        if action is None: #if reset
+            frames = self.frames[stream] = deque([obs]*self.stack_frames, maxlen=self.stack_frames)
+            self.last_frames[stream] = LazyFrames(list(frames))
+        else:
+            frames = self.frames[stream]
+            frames.append(obs)
+            current_frames = LazyFrames(list(frames))
+            self._storage(stream).add(self.last_frames[stream], action, reward, current_frames, done)
+            self.last_frames[stream] = current_frames
+
+    def _storage(self, stream):
+        # the buffer the transitions of *stream* are stored in
+        return self.replay_buffer
+
+    def _before_sample(self):
+        pass
+
+    def _sample(self):
+        if not self.is_init_cache:
+            self.is_init_cache=True
+            batch = self.replay_buffer.sample(self.batch_size)
+            self.memory_share_list = [torch.zeros((self.cache_size, *x.shape), dtype=torch.tensor(x).dtype, device=torch.device(0)).share_memory_() for x in batch]
+            for i in range(0, self.cache_size): # no need update 0
+                self._fill_cache(i)
+            self.__worker_pipe.send([True, self.memory_share_list]) # the first one denoteing construction of share memory
+        else:
+            self.__worker_pipe.send([False, self.out_pointer])
+            self.out_pointer = (self.out_pointer + 1)%self.cache_size
+            self._fill_cache(self.in_pointer)
+            self.in_pointer = (self.in_pointer + 1) % self.cache_size
+
+    def _fill_cache(self, i):
+        for share, x in zip(self.memory_share_list, self.replay_buffer.sample(self.batch_size)):
+            share[i] = torch.tensor(x, device=torch.device(0))
+        torch.cuda.synchronize(torch.device(0)) # the batch is complete before the learner is told about it
+
     def run(self):
+        profiler.init('replay_buffer', **self.profile_options)
         self.init_seed()
-        replay_buffer = ReplayBuffer(self.buffer_size)
-        memory_share_list = []
-        frames = deque([], maxlen=self.stack_frames)
+        self._init_storage()
+        self.ready_time.value = time.time()
         while True:
             cmd, data = self.__worker_pipe.recv()
             if cmd == self.ADD:
-                action, obs, reward, done = data
-                if action is None: #if reset
-                    for _ in range(self.stack_frames):
-                        frames.append(obs)
-                    self.last_frames = LazyFrames(list(frames))
-                else:
-                    frames.append(obs)
-                    current_frames = LazyFrames(list(frames))
-                    replay_buffer.add(self.last_frames, action, reward, current_frames, done)
-                    self.last_frames = current_frames
+                with profiler.span('replay.add'):
+                    self._add(*data)
 
             elif cmd == self.SAMPLE:
-                if not self.is_init_cache:
-                    self.is_init_cache=True
-                    state, action, reward, next_state, done = replay_buffer.sample(self.batch_size)
-                    state_share = torch.zeros((self.cache_size, *state.shape), dtype=torch.tensor(state).dtype, device=torch.device(0)).share_memory_()
-                    action_share = torch.zeros((self.cache_size, *action.shape), dtype=torch.tensor(action).dtype, device=torch.device(0)).share_memory_()
-                    reward_share = torch.zeros((self.cache_size, *reward.shape), dtype=torch.tensor(reward).dtype, device=torch.device(0)).share_memory_()
-                    next_state_share = torch.zeros((self.cache_size, *next_state.shape), dtype=torch.tensor(next_state).dtype, device=torch.device(0)).share_memory_()
-                    done_share = torch.zeros((self.cache_size, *done.shape), dtype=torch.tensor(done).dtype, device=torch.device(0)).share_memory_()
-                    for i in range(0, self.cache_size): # no need update 0
-                        state, action, reward, next_state, done = replay_buffer.sample(self.batch_size)
-                        state_share[i] = torch.tensor(state, device=torch.device(0))
-                        action_share[i] = torch.tensor(action, device=torch.device(0))
-                        reward_share[i] = torch.tensor(reward, device=torch.device(0))
-                        next_state_share[i] = torch.tensor(next_state, device=torch.device(0))
-                        done_share[i] = torch.tensor(done, device=torch.device(0))
-                    memory_share_list = [state_share, action_share, reward_share, next_state_share, done_share]
-                    self.__worker_pipe.send([True, memory_share_list]) # the first one denoteing construction of share memory
-                else:
-                    self.__worker_pipe.send([False, self.out_pointer])
-                    self.out_pointer = (self.out_pointer + 1)%self.cache_size
-
-                    state, action, reward, next_state, done = replay_buffer.sample(self.batch_size)
-                    state_share[self.in_pointer] = torch.tensor(state, device=torch.device(0))
-                    action_share[self.in_pointer] = torch.tensor(action, device=torch.device(0))
-                    reward_share[self.in_pointer] = torch.tensor(reward, device=torch.device(0))
-                    next_state_share[self.in_pointer] = torch.tensor(next_state, device=torch.device(0))
-                    done_share[self.in_pointer] = torch.tensor(done, device=torch.device(0))
-                    self.in_pointer = (self.in_pointer + 1) % self.cache_size
+                with profiler.span('replay.sample'):
+                    self._before_sample()
+                    self._sample()
 
             elif cmd == self.CLOSE:
                 self.__worker_pipe.close()
@@ -91,21 +143,22 @@ class ReplayBufferAsync(mp.Process):
             else:
                 raise Exception('Unknown command')
 
-    def add(self, action, obs, reward, done):
+    def add(self, action, obs, reward, done, stream=0, *extra):
         '''
         if action is none, it is the reset frame
+        stream identifies the actor
         '''
-        data = (action, obs, reward, done)
+        data = (action, obs, reward, done, stream, *extra)
         self.__pipe.send([self.ADD, data])
 
     def sample(self):
-        self.__pipe.send([self.SAMPLE, None])
-        is_construct_cache, data = self.__pipe.recv()
+        with profiler.span('learner.replay_sample_wait'):
+            self.__pipe.send([self.SAMPLE, None])
+            is_construct_cache, data = self.__pipe.recv()
         if is_construct_cache:
-            self.state_share, self.action_share, self.reward_share, self.next_state_share, self.done_share =  data
-            return self.state_share[0], self.action_share[0], self.reward_share[0], self.next_state_share[0], self.done_share[0]
-        else:
-            return self.state_share[data], self.action_share[data], self.reward_share[data], self.next_state_share[data], self.done_share[data]
+            self.memory_share_list = data
+            data = 0
+        return tuple(share[data] for share in self.memory_share_list)
 
     def close(self):
         self.__pipe.send([self.CLOSE, None])
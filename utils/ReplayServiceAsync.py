@@ -0,0 +1,271 @@
+import os
+import time
+import threading
+import queue
+import torch
+import numpy as np
+import torch.multiprocessing as mp
+from multiprocessing.connection import Listener, Client
+from collections import deque
+import random
+from utils.Wrapper import LazyFrames
+from utils.ReplayBufferAsync import ReplayBuffer
+from utils.StartupTimer import startup_timer
+from utils.Profiler import profiler, Profiler
+
+class ReplayServerAsync(mp.Process):
+    '''
+    Replay store served on a unix socket, request/response over multiprocessing connections, one thread per connection
+    Any number of ReplayClient can connect: actors insert, learners sample, analysis tools scan
+    ADD     list of (stream, action, obs, reward, done)  -> ack (the client waits on acks for backpressure)
+    SAMPLE  (batch_size, num_batches)                   -> stacked numpy batches, or None if the buffer is empty
+    SCAN    (start, stop)                               -> transitions [start, stop) in storage order, read only
+    STATS   None                                        -> dict
+    CLOSE   None                                        -> shut the server down
+    '''
+    ADD = 0
+    SAMPLE = 1
+    SCAN = 2
+    STATS = 3
+    CLOSE = 4
+
+    def __init__(self, *arg, **args):
+        mp.Process.__init__(self)
+        self.address = args['replay_address']
+        self.buffer_size = args['buffer_size']
+        self.stack_frames = args['stack_frames']
+        self.seed = args['seed']
+        self.ready_time = startup_timer.register('replay_server')
+        self.profile_options = Profiler.options(**args)
+        self.start()
+
+    def init_seed(self):
+        torch.manual_seed(self.seed)
+        random.seed(self.seed)
+        np.random.seed(self.seed)
+
+    def _accept(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except OSError: # listener closed
+                return
+            with self.connections_lock:
+                self.connections.append(conn)
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        '''
+        One thread per connection, so that a client which is slow to read a large reply
+        (or is itself blocked on another connection) never stalls the other clients.
+        The store is guarded by *lock*, replies are sent outside of it.
+        '''
+        while True:
+            try:
+                cmd, data = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                reply = self._handle(cmd, data)
+            if cmd == self.CLOSE:
+                self.closed.set()
+                break
+            try:
+                conn.send(reply)
+            except OSError: # client gone
+                break
+        with self.connections_lock:
+            if conn in self.connections: self.connections.remove(conn)
+        conn.close()
+
+    def _handle(self, cmd, data):
+        if cmd == self.ADD:
+            with profiler.span('replay.add'):
+                for transition in data:
+                    self._add(*transition)
+            return len(self.replay_buffer)
+
+        elif cmd == self.SAMPLE:
+            batch_size, num_batches = data
+            if len(self.replay_buffer) == 0: return None
+            with profiler.span('replay.sample'):
+                batches = [self.replay_buffer.sample(batch_size) for _ in range(num_batches)]
+                reply = [np.stack(field) for field in zip(*batches)]
+            self.sampled += batch_size * num_batches
+            return reply
+
+        elif cmd == self.SCAN:
+            start, stop = data
+            idxes = range(start, min(stop, len(self.replay_buffer)))
+            return self.replay_buffer._encode_sample(idxes) if len(idxes) > 0 else None
+
+        elif cmd == self.STATS:
+            with self.connections_lock:
+                clients = len(self.connections)
+            return {'size': len(self.replay_buffer), 'inserted': self.inserted, 'sampled': self.sampled, 'clients': clients}
+
+        elif cmd == self.CLOSE:
+            return None
+        else:
+            raise Exception('Unknown command')
+
+    def _add(self, stream, action, obs, reward, done):
+        '''
+        if action is none, it is the reset frame
+        frames are stacked per stream, so that transitions of different actors do not mix
+        '''
+        if action is None:
+            frames = self.frames[stream] = deque([obs]*self.stack_frames, maxlen=self.stack_frames)
+            self.last_frames[stream] = LazyFrames(list(frames))
+        else:
+            frames = self.frames[stream]
+            frames.append(obs)
+            current_frames = LazyFrames(list(frames))
+            self.replay_buffer.add(self.last_frames[stream], action, reward, current_frames, done)
+            self.last_frames[stream] = current_frames
+            self.inserted += 1
+
+    def run(self):
+        profiler.init('replay_server', **self.profile_options)
+        self.init_seed()
+        self.replay_buffer = ReplayBuffer(self.buffer_size)
+        self.frames, self.last_frames = dict(), dict()
+        self.inserted, self.sampled = 0, 0
+        self.lock = threading.Lock()
+        self.connections, self.connections_lock = [], threading.Lock()
+        self.closed = threading.Event()
+        if os.path.exists(self.address): os.unlink(self.address)
+        listener = Listener(self.address, family='AF_UNIX')
+        threading.Thread(target=self._accept, args=(listener,), daemon=True).start()
+        self.ready_time.value = time.time()
+        while not self.closed.wait(0.1): # the main thread only waits, so that it can still handle signals
+            pass
+        listener.close()
+        with self.connections_lock:
+            for conn in self.connections: conn.close()
+
+class ReplayClient:
+    '''
+    Client of ReplayServerAsync with the same add/sample interface as ReplayBufferAsync
+    Inserts are sent in batches of *replay_insert_batch*, at most *replay_max_inflight* batches are unacknowledged
+    Samples are requested *replay_prefetch* batches at a time, the next request is sent before the current batches are used.
+    The replies on the sample connection are read by a thread as soon as they arrive, so that the server is never
+    blocked writing a large reply while this client is blocked in a flush (the inserts go through the other connection)
+    If device is None, sample returns numpy arrays (e.g. offline analysis), otherwise tensors on device
+    '''
+    def __init__(self, device=torch.device(0), connect_timeout=60, **args):
+        self.address = args['replay_address']
+        self.batch_size = args['batch_size']
+        self.insert_batch = args['replay_insert_batch']
+        self.max_inflight = args['replay_max_inflight']
+        self.prefetch = args['replay_prefetch']
+        self.device = device
+        self.connect_timeout = connect_timeout
+        self.client_id = os.getpid()
+        self._insert_conn, self._sample_conn = None, None
+        self.insert_cache, self.inflight = [], 0
+        self.sample_cache, self.sample_requested = deque(), False
+        self.replies = queue.Queue()
+
+    def _connect(self):
+        tic = time.time()
+        while True:
+            try:
+                return Client(self.address, family='AF_UNIX')
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.time() - tic > self.connect_timeout: raise
+                time.sleep(0.1)
+
+    @property
+    def insert_conn(self):
+        if self._insert_conn is None: self._insert_conn = self._connect()
+        return self._insert_conn
+
+    @property
+    def sample_conn(self):
+        if self._sample_conn is None:
+            self._sample_conn = self._connect()
+            threading.Thread(target=self._receive, args=(self._sample_conn,), daemon=True).start()
+        return self._sample_conn
+
+    def _receive(self, conn):
+        # the replies arrive in the order of the requests
+        while True:
+            try:
+                self.replies.put(conn.recv())
+            except (EOFError, OSError): # closed
+                return
+
+    def add(self, action, obs, reward, done, stream=0):
+        '''
+        if action is none, it is the reset frame
+        '''
+        self.insert_cache.append(((self.client_id, stream), action, obs, reward, done))
+        if len(self.insert_cache) >= self.insert_batch:
+            self.flush()
+
+    def flush(self):
+        if len(self.insert_cache) > 0:
+            self.insert_conn.send([ReplayServerAsync.ADD, self.insert_cache])
+            self.insert_cache = []
+            self.inflight += 1
+        while self.inflight > self.max_inflight: # backpressure, wait until the server catches up
+            self.insert_conn.recv()
+            self.inflight -= 1
+
+    def _request_samples(self):
+        self.sample_conn.send([ReplayServerAsync.SAMPLE, [self.batch_size, self.prefetch]])
+        self.sample_requested = True
+
+    def _receive_samples(self):
+        batches = self.replies.get()
+        self.sample_requested = False
+        if batches is None: # buffer is still empty
+            return False
+        if self.device is not None:
+            batches = [torch.as_tensor(field, device=self.device) for field in batches]
+        self.sample_cache.extend(zip(*batches))
+        return True
+
+    def _drain(self):
+        # the reply of an outstanding prefetch arrives before any other reply
+        if self.sample_requested: self._receive_samples()
+
+    def sample(self):
+        with profiler.span('learner.replay_sample_wait'):
+            while len(self.sample_cache) == 0:
+                if not self.sample_requested: self._request_samples()
+                if not self._receive_samples():
+                    self.flush()
+                    time.sleep(0.1)
+                    continue
+                self._request_samples() # prefetch while the cached batches are used
+        return self.sample_cache.popleft()
+
+    def scan(self, start=0, stop=None, chunk_size=1024):
+        '''
+        Read only iteration over the stored transitions in storage order
+        yield (state, action, reward, next_state, done) numpy arrays of at most chunk_size transitions
+        '''
+        stop = self.stats()['size'] if stop is None else stop
+        for chunk_start in range(start, stop, chunk_size):
+            self._drain()
+            self.sample_conn.send([ReplayServerAsync.SCAN, [chunk_start, min(chunk_start + chunk_size, stop)]])
+            data = self.replies.get()
+            if data is None: return
+            yield data
+
+    def stats(self):
+        self._drain()
+        self.sample_conn.send([ReplayServerAsync.STATS, None])
+        return self.replies.get()
+
+    def shutdown(self):
+        self.flush()
+        self._drain()
+        self.sample_conn.send([ReplayServerAsync.CLOSE, None])
+
+    def close(self):
+        self.flush()
+        for conn in (self._insert_conn, self._sample_conn):
+            if conn is not None: conn.close()
@@ -0,0 +1,133 @@
+import os
+import numpy as np
+from utils.ReplayBufferAsync import ReplayBufferAsync
+from utils.MemoryMonitor import FRAME_BYTES
+
+class SequenceReplayBuffer(object):
+    '''
+    R2D2 style sequence storage, one frame per step in contiguous ring arrays (no frame stacking)
+    Slot i holds
+        obs[i]              the frame
+        first[i]            obs[i] is a reset frame, the recurrent state is reset before it
+        recurrent_state[i // stride]  the recurrent state of the actor before obs[i], only kept where a sequence can start
+        action[i], reward[i], done[i] of the transition from obs[i]
+        valid[i]            the transition from obs[i] is stored (False for the last frame of an episode)
+    A sequence is the slice [start, start + burn_in + sequence_length + 1), starts are multiples of *stride*,
+    so consecutive sequences overlap. Sampling a batch is one gather per array.
+    The size is rounded down to a multiple of stride, so that the sequence starts stay at the same slots when the ring wraps.
+    If spill_path is given, the frames and recurrent states are memory mapped files instead of RAM
+    '''
+    def __init__(self, size, burn_in, sequence_length, stride, state_size, spill_path=None):
+        self._maxsize = size - size % stride
+        self.length = burn_in + sequence_length + 1
+        self.stride = stride
+        self.state_size = state_size
+        self.pointer = 0 # total frames written, the next slot is pointer % size
+        self.spill_path = spill_path
+        self.obs = None
+
+    def _zeros(self, name, shape, dtype):
+        if self.spill_path is None:
+            return np.zeros(shape, dtype=dtype)
+        path = self.spill_path + '_' + name + '.npy'
+        array = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        os.unlink(path) # the mapping keeps the file alive, the disk space is freed when the process exits
+        return array
+
+    def __len__(self):
+        return min(self.pointer, self._maxsize)
+
+    def _allocate(self, obs):
+        self.obs = self._zeros('obs', (self._maxsize, *obs.shape), obs.dtype)
+        self.first = np.zeros(self._maxsize, dtype=bool)
+        self.recurrent_state = self._zeros('recurrent_state', (self._maxsize // self.stride, self.state_size), np.float32)
+        self.action = np.zeros(self._maxsize, dtype=np.int64)
+        self.reward = np.zeros(self._maxsize, dtype=np.float32)
+        self.done = np.zeros(self._maxsize, dtype=bool)
+        self.valid = np.zeros(self._maxsize, dtype=bool)
+
+    def add_frame(self, obs, first):
+        if self.obs is None: self._allocate(obs)
+        i = self.pointer % self._maxsize
+        self.obs[i] = obs
+        self.first[i] = first
+        self.valid[i] = False
+        self.pointer += 1
+
+    def add_transition(self, action, reward, done, recurrent_state):
+        # the transition from the last written frame
+        i = (self.pointer - 1) % self._maxsize
+        self.action[i] = action
+        self.reward[i] = reward
+        self.done[i] = done
+        if i % self.stride == 0: # only read at the start of a sequence
+            self.recurrent_state[i // self.stride] = recurrent_state
+        self.valid[i] = True
+
+    def num_sequences(self):
+        oldest = max(0, self.pointer - self._maxsize)
+        first_start = -(-oldest // self.stride) * self.stride
+        return max(0, (self.pointer - self.length - first_start) // self.stride + 1), first_start
+
+    def sample(self, batch_size):
+        '''
+        return obs (B, L+1, ...), action, reward, done, valid (B, L), first (B, L+1), recurrent_state (B, state_size)
+        where L = burn_in + sequence_length
+        '''
+        num_sequences, first_start = self.num_sequences()
+        if num_sequences <= 0: raise Exception('Not enough steps in the sequence replay buffer, increase --start_training_steps')
+        starts = first_start + self.stride * np.random.randint(num_sequences, size=batch_size)
+        idxes = (starts[:, None] + np.arange(self.length)) % self._maxsize
+        step_idxes = idxes[:, :-1]
+        return self.obs[idxes], self.action[step_idxes], self.reward[step_idxes], self.done[step_idxes], \
+            self.valid[step_idxes], self.first[idxes], self.recurrent_state[idxes[:, 0] // self.stride]
+
+class PartitionedSequenceReplayBuffer(object):
+    '''
+    One SequenceReplayBuffer per stream (actor), so that the steps of a stream stay contiguous
+    A batch is split among the partitions in proportion to their number of sequences
+    '''
+    def __init__(self, num_streams, size, burn_in, sequence_length, stride, state_size, spill_dir=None):
+        if spill_dir is not None: os.makedirs(spill_dir, exist_ok=True)
+        self.partitions = [SequenceReplayBuffer(size // num_streams, burn_in, sequence_length, stride, state_size,
+            spill_path = None if spill_dir is None else os.path.join(spill_dir, 'replay_%d_%d'%(os.getpid(), stream))) for stream in range(num_streams)]
+
+    def __len__(self):
+        return sum(len(partition) for partition in self.partitions)
+
+    def sample(self, batch_size):
+        num_sequences = np.array([partition.num_sequences()[0] for partition in self.partitions], dtype=np.float64)
+        if num_sequences.sum() == 0: raise Exception('Not enough steps in the sequence replay buffer, increase --start_training_steps')
+        batch_sizes = np.random.multinomial(batch_size, num_sequences / num_sequences.sum())
+        batches = [partition.sample(size) for partition, size in zip(self.partitions, batch_sizes) if size > 0]
+        return tuple(np.concatenate(field) for field in zip(*batches))
+
+class SequenceReplayBufferAsync(ReplayBufferAsync):
+    '''
+    add numpy, with the recurrent state of the actor before the previous frame
+    sample torch.tensor.cuda() sequences, see SequenceReplayBuffer.sample
+    '''
+    supports_spill = True
+
+    @staticmethod
+    def bytes_per_step(**args):
+        # frame, recurrent state (one per sequence start), action, reward, done, first, valid
+        return FRAME_BYTES + 4 * 2 * args['recurrent_hidden_size'] / args['sequence_stride'] + 8 + 4 + 3
+
+    def __init__(self, *arg, **args):
+        self.burn_in = args['burn_in']
+        self.sequence_length = args['sequence_length']
+        self.sequence_stride = args['sequence_stride']
+        self.state_size = 2 * args['recurrent_hidden_size'] # (h, c) of the LSTM
+        self.num_streams = args['num_actors']
+        self.spill_dir = args['replay_spill_dir']
+        super().__init__(*arg, **args)
+
+    def _init_storage(self):
+        self.replay_buffer = PartitionedSequenceReplayBuffer(self.num_streams, self.buffer_size, self.burn_in, self.sequence_length, self.sequence_stride, self.state_size, self.spill_dir)
+
+    def _add(self, action, obs, reward, done, stream=0, recurrent_state=None):
+        partition = self.replay_buffer.partitions[stream]
+        if action is not None:
+            partition.add_transition(action, reward, done, recurrent_state)
+        partition.add_frame(obs, first = action is None)
@@ -0,0 +1,34 @@
+import time
+import torch.multiprocessing as mp
+
+class StartupTimer:
+    '''
+    Wall clock of the startup stages of the main process and the time at which every worker is ready
+    Workers get a shared value when constructed (before start), and set it at the top of their loop
+    '''
+    def __init__(self):
+        self.start_time = time.time()
+        self.last_time = self.start_time
+        self.stages = []
+        self.workers = []
+
+    def mark(self, stage):
+        now = time.time()
+        self.stages.append((stage, now - self.last_time))
+        self.last_time = now
+
+    def register(self, worker_name):
+        ready_time = mp.Value('d', 0., lock=False)
+        self.workers.append((worker_name, ready_time))
+        return ready_time
+
+    def report(self):
+        '''
+        return dict of seconds, a worker which is not ready yet is None
+        '''
+        report = {'startup/' + stage: duration for stage, duration in self.stages}
+        for worker_name, ready_time in self.workers: # worker names are unique, e.g. actor_0
+            report['startup/%s_ready'%worker_name] = ready_time.value - self.start_time if ready_time.value > 0 else None
+        return report
+
+startup_timer = StartupTimer()
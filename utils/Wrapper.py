@@ -3,10 +3,29 @@ import numpy as np
 from gym.spaces.box import Box
 from collections import deque
 from gym import spaces
-from baselines.common.atari_wrappers import FrameStack as FrameStack_, make_atari, wrap_deepmind
+
+def num_games(**args):
+    return 1 if args['env_names'] is None else len(args['env_names'])
+
+def game_args(game, **args):
+    '''
+    args of the env of game *game* in the multi-task mode (--env_names), args otherwise
+    '''
+    if args['env_names'] is None: return args
+    return dict(args, env_name=args['env_names'][game])
 
 def make_env(**args):
-        env = make_atari(args['env_name'], max_episode_steps=args['max_episode_steps'])
+        from baselines.common.atari_wrappers import make_atari, wrap_deepmind, NoopResetEnv, MaxAndSkipEnv # opencv and the atari wrappers are only imported where an env is built
+        if args['env_names'] is None:
+            env = make_atari(args['env_name'], max_episode_steps=args['max_episode_steps'])
+        else: # as make_atari, with the 18 actions of the full action space, so that all games share the network outputs
+            from baselines.common.wrappers import TimeLimit
+            env = gym.make(args['env_name'], full_action_space=True)
+            assert 'NoFrameskip' in env.spec.id
+            env = NoopResetEnv(env, noop_max=30)
+            env = MaxAndSkipEnv(env, skip=4)
+            if args['max_episode_steps'] is not None:
+                env = TimeLimit(env, max_episode_steps=args['max_episode_steps'])
         env = OriginalReturnWrapper(env)
         env = wrap_deepmind(env,
                             episode_life=args['episode_life'],
@@ -60,7 +79,7 @@ class TransposeImage(gym.ObservationWrapper):
 '''
 origianl one stack at the last index, we hope to stack at the first index
 '''
-class FrameStack(FrameStack_):
+class FrameStack(gym.Wrapper):
     def __init__(self, env, k):
         """Stack k last frames.
 
@@ -76,6 +95,17 @@ class FrameStack(FrameStack_):
         shp = env.observation_space.shape
         self.observation_space = spaces.Box(low=0, high=255, shape=(shp[0]*k, shp[1], shp[2]), dtype=env.observation_space.dtype)
 
+    def reset(self):
+        ob = self.env.reset()
+        for _ in range(self.k):
+            self.frames.append(ob)
+        return self._get_ob()
+
+    def step(self, action):
+        ob, reward, done, info = self.env.step(action)
+        self.frames.append(ob)
+        return self._get_ob(), reward, done, info
+
     def _get_ob(self):
         assert len(self.frames) == self.k
         return LazyFrames(list(self.frames))